@@ -0,0 +1,65 @@
+"""
+Packs the profile folders archived by watcher.py into one tar per profile, or reads files back out of them.
+By: ProgrammingIncluded
+"""
+
+import os
+import sys
+import argparse
+
+# Load the source root directory
+FILE_PATH = os.path.dirname(__file__)
+SRC_ROOT = os.path.join(FILE_PATH, os.pardir, "src")
+sys.path.append(SRC_ROOT)
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.pack import PackReader, pack_fpath, pack_tree
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Twitter Bird Watcher. Packing archived profiles.")
+    parser.add_argument("--output_fpath", "-o", help="Output folder of watcher.py.", default="snapshots")
+    parser.add_argument("--keep", help="Keep the folders once packed.", action="store_true")
+
+    read_group = parser.add_mutually_exclusive_group()
+    read_group.add_argument("--list", metavar="USERNAME", help="List the files packed for a profile.")
+    read_group.add_argument("--cat", nargs=2, metavar=("USERNAME", "FILE"), help="Write a packed file, e.g. 123/123.png, to stdout.")
+    read_group.add_argument("--unpack", metavar="USERNAME", help="Restore the folder of a packed profile.")
+    return parser.parse_args()
+
+def open_pack(root_dir: str, username: str) -> PackReader:
+    pack = pack_fpath(os.path.join(root_dir, username.lstrip("@")))
+    if not os.path.exists(pack):
+        logger.error("No pack at {}.".format(pack))
+        sys.exit(1)
+    return PackReader(pack)
+
+def main():
+    args = parse_args()
+
+    if args.list:
+        for name in open_pack(args.output_fpath, args.list).names():
+            print(name)
+        return
+
+    if args.cat:
+        username, name = args.cat
+        reader = open_pack(args.output_fpath, username)
+        if name not in reader:
+            logger.error("{} is not packed for {}.".format(name, username))
+            sys.exit(1)
+        sys.stdout.buffer.write(reader.read(name))
+        return
+
+    if args.unpack:
+        folder = os.path.join(args.output_fpath, args.unpack.lstrip("@"))
+        count = open_pack(args.output_fpath, args.unpack).extract(folder)
+        logger.info("Restored {} files to {}.".format(count, folder))
+        return
+
+    totals = pack_tree(args.output_fpath, remove=not args.keep)
+    logger.info("Packed {} files, {:.1f}MB, of {} profiles.".format(totals["files"], totals["bytes"] / 1e6, totals["profiles"]))
+
+if __name__ == "__main__":
+    main()
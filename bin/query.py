@@ -0,0 +1,87 @@
+"""
+Searches the tweets archived by watcher.py through the index kept with --index.
+By: ProgrammingIncluded
+"""
+
+import os
+import sys
+import json
+import argparse
+
+# Load the source root directory
+FILE_PATH = os.path.dirname(__file__)
+SRC_ROOT = os.path.join(FILE_PATH, os.pardir, "src")
+sys.path.append(SRC_ROOT)
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.index import INDEX_DB, ArchiveIndex
+from tb_watcher.pack import locate_packed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Twitter Bird Watcher. Searching archived tweets.")
+    parser.add_argument("--output_fpath", "-o", help="Output folder of watcher.py.", default="snapshots")
+    parser.add_argument("--db", help="Index to search, defaults to {} in the output folder.".format(INDEX_DB))
+    parser.add_argument("--reindex", help="Index files changed since the index was last updated first.", action="store_true")
+
+    filter_group = parser.add_argument_group("filters")
+    filter_group.add_argument("--handle", help="Tweets of this handle, with or without @.")
+    filter_group.add_argument("--since", help="Tweets from this date or ISO time on, e.g. 2023-01-31.")
+    filter_group.add_argument("--until", help="Tweets before this date or ISO time.")
+    filter_group.add_argument("--text", help="Full text search of tweets, FTS5 query syntax when available.")
+    filter_group.add_argument("--parent", help="Replies to this tweet id.")
+    filter_group.add_argument("--id", help="This tweet id.")
+    filter_group.add_argument("--profile", help="Print the bio of this username instead of tweets.")
+    filter_group.add_argument("--limit", help="Max tweets to print.", default=50, type=int)
+
+    parser.add_argument("--json", help="Print one JSON object per line.", action="store_true")
+    return parser.parse_args()
+
+def screenshot_location(root_dir: str, rel: str) -> str:
+    """Path of a screenshot, or <pack>:<name> once its profile is packed."""
+    fpath = os.path.join(root_dir, rel)
+    packed = None if os.path.exists(fpath) else locate_packed(root_dir, rel)
+    return fpath if packed is None else "{}:{}".format(*packed)
+
+def main():
+    args = parse_args()
+    db = args.db or os.path.join(args.output_fpath, INDEX_DB)
+    if not args.reindex and not os.path.exists(db):
+        logger.error("No index at {}, run watcher.py with --index or pass --reindex.".format(db))
+        sys.exit(1)
+
+    index = ArchiveIndex(db, args.output_fpath)
+    if args.reindex:
+        logger.info("Indexed {updated} changed of {files} files, dropped {removed} removed ones.".format(**index.index_tree()))
+
+    if args.profile:
+        bio = index.profile(args.profile)
+        if bio is None:
+            logger.error("No bio archived for {}.".format(args.profile))
+            sys.exit(1)
+        print(json.dumps(bio, ensure_ascii=False) if args.json else "\n".join("{}: {}".format(k, v) for k, v in bio.items()))
+        return
+
+    tweets = index.query(
+        handle=args.handle,
+        since=args.since,
+        until=args.until,
+        text=args.text,
+        parent_id=args.parent,
+        tweet_id=args.id,
+        limit=args.limit)
+
+    for t in tweets:
+        if args.json:
+            print(json.dumps(t, ensure_ascii=False))
+            continue
+
+        print("{} {} {} ({})".format(t["datetime"] or t["timestamp"], t["handle"], t["id"], t["path"]))
+        print("    {}".format((t["tweet_text"] or "").replace("\n", "\n    ")))
+        if t["screenshot"]:
+            print("    screenshot: {}".format(screenshot_location(args.output_fpath, t["screenshot"])))
+    logger.info("{} tweets.".format(len(tweets)))
+
+if __name__ == "__main__":
+    main()
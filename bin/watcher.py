@@ -3,29 +3,37 @@ BTWatcher snapshots a profile page when given a URL or an exported list of `foll
 By: ProgrammingIncluded
 """
 
+import time
+
+# Measured before anything else is imported.
+START_TIME = time.perf_counter()
+
 import re
 import os
 import sys
 import json
 import argparse
 
+from typing import List
+
 # Load the source root directory
 FILE_PATH = os.path.dirname(__file__)
 SRC_ROOT = os.path.join(FILE_PATH, os.pardir, "src")
 sys.path.append(SRC_ROOT)
 
 # tb_watcher
+# Anything importing selenium is imported in main() so --help stays fast.
 import tb_watcher.swag as swag
 
-from tb_watcher.core import fetch_html
 from tb_watcher.logger import logger
-from tb_watcher.driver_utils import create_chrome_driver
-from tb_watcher.math_utils import calc_average_percentile, window_average, constant
-
-# selenium
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
+from tb_watcher.settings import CrawlSettings
+from tb_watcher.budget import BUDGET, log_budget_report
+from tb_watcher.index import INDEX_DB, init_index
+from tb_watcher.screenshots import BLOB_DIR, FORMATS, SCREENSHOTS, log_screenshot_report
+from tb_watcher.resources import PRESETS, log_resource_report, set_resource_policy
+from tb_watcher.sharding import DEF_LEASE_TTL, init_leases, in_shard, merge_reports, parse_shard, write_shard_report
+from tb_watcher.chromedriver import CHROMEDRIVER_ENV, resolve_chromedriver_path
+from tb_watcher.math_utils import make_offset_func
 
 
 def parse_args():
@@ -40,6 +48,8 @@ def parse_args():
     runtime_group = parser.add_argument_group("runtime states")
     runtime_group.add_argument("--force", "-f", help="Force re-download everything. WARNING, will delete outputs.", action="store_true")
     runtime_group.add_argument("--posts", "-p", help="Max number of posts to screenshot.", default=20, type=int)
+    runtime_group.add_argument("--incremental", help="Update existing profiles with their new tweets, instead of skipping them.", action="store_true")
+    runtime_group.add_argument("--known-stop", help="With --incremental, stop a profile after this many archived tweets in a row. 0 to never stop.", default=10, type=int)
     runtime_group.add_argument("--bio-only", "-b", help="Only store bio, no snapshots of tweets.", action="store_true")
     runtime_group.add_argument("--debug", help="Print debug output.", action="store_true")
     runtime_group.add_argument("--multi-threading", "-t", help="Number of threads to spawn.", type=int, default=default_cpu_count)
@@ -47,13 +57,64 @@ def parse_args():
                                                                            "1 means only main threads on profile."
                                                                            "2 means threads including responses on each tweet on profile."
                                                                            "3 means threads of threads. So-on and so-forth."
-                                                                           "Note that duplicates will occur for >= 3."))
+                                                                           "Threads reached more than once are only archived once."))
+    runtime_group.add_argument("--max-page-loads", help=("Max pages loaded by the whole crawl, 0 for no limit. "
+                                                         "Profiles go first, deeper threads are left out once reached."), default=0, type=int)
+    runtime_group.add_argument("--max-wall-time", help=("Max seconds (float) for the whole crawl, 0 for no limit. "
+                                                        "Profiles already started finish, threads are stopped or left out."), default=0.0, type=float)
+    runtime_group.add_argument("--workers-mode", help=("Run workers as threads sharing this process, or as processes each owning a Chrome. "
+                                                       "A crashed or stuck process only loses its current job, which is retried."),
+                               choices=["thread", "process"], default="thread")
+    runtime_group.add_argument("--job-timeout", help="Max seconds (float) a worker process may spend on one job before it is restarted. 0 to never restart.", default=0.0, type=float)
+    runtime_group.add_argument("--frontier", help=("SQLite file keeping the jobs of the crawl. An interrupted crawl resumes from it, "
+                                                   "and several watchers given the same file share its jobs."))
+    runtime_group.add_argument("--queue-size", help="Max profile jobs waiting for a thread before the main thread waits to queue more.", default=64, type=int)
+    runtime_group.add_argument("--tabs", help="Tabs per Chrome, each running a thread's jobs. Higher values use less memory per thread.", default=1, type=int)
+    runtime_group.add_argument("--driver-recycle", help="Restart a worker's Chrome after this many page loads. 0 to never restart.", default=50, type=int)
+    runtime_group.add_argument("--prune-dom", help="Empty archived tweets scrolled past to keep browser memory flat on long profiles.", action="store_true")
+
+    runtime_group.add_argument("--pack", help=("Pack the folder of each profile into <username>.tar once it is done, "
+                                               "with an index to read any file of it. See bin/pack.py."), action="store_true")
+    runtime_group.add_argument("--index", help=("Keep <output>/{} up to date with every archived tweet and bio, "
+                                                "to be searched with bin/query.py.").format(INDEX_DB), action="store_true")
+
+    runtime_group.add_argument("--chromedriver", help="Path to a chromedriver binary, skips resolving one. Also read from ${}.".format(CHROMEDRIVER_ENV))
 
     verification_group = parser.add_argument_group("verification")
     verification_group.add_argument("--login", help="Prompt user login to remove limits / default filters. USE AT OWN RISK.", action="store_true")
 
+    loading_group = parser.add_argument_group("page loading")
+    loading_group.add_argument("--ready-timeout", help="Max seconds (float) to wait for a page to be ready.", default=30.0, type=float)
+    loading_group.add_argument("--ready-quiet", help="Seconds (float) without new network requests or layout changes for a page to be ready.", default=0.5, type=float)
+    loading_group.add_argument("--ready-jitter", help="Max random seconds (float) to wait after a page is ready, to be polite.", default=0.0, type=float)
+
+    screenshot_group = parser.add_argument_group("screenshots")
+    screenshot_group.add_argument("--screenshot-format", help=("png writes screenshots as captured. optimized and webp recompress them "
+                                                              "losslessly in the background, which needs Pillow."), choices=FORMATS, default="png")
+    screenshot_group.add_argument("--capture-mode", help=("element captures each tweet. viewport captures the screen once and crops "
+                                                         "every tweet entirely on it, which needs Pillow."), choices=["element", "viewport"], default="element")
+    screenshot_group.add_argument("--screenshot-writers", help="Threads writing screenshots in the background.", default=2, type=int)
+    screenshot_group.add_argument("--screenshot-store", help=("Store identical screenshots once, in <output>/{}, hardlinked to where they belong. "
+                                                             "Saves disk across depths, re-runs and retweets.").format(BLOB_DIR), action="store_true")
+    screenshot_group.add_argument("--screenshot-fsync", help="Flush every screenshot to disk before counting it written. Slower, survives power loss.", action="store_true")
+
+    loading_group.add_argument("--resource-policy", help=("Resources Chrome does not download. screenshots blocks videos and trackers, "
+                                                         "text also blocks images and fonts, for --bio-only or when screenshots do not matter. "
+                                                         "Defaults to text with --bio-only, none otherwise."),
+                               choices=list(PRESETS.keys()))
+    loading_group.add_argument("--block-url", help="Also block URLs matching this pattern, with * as wildcard. Can be repeated.",
+                               action="append", default=[])
+    loading_group.add_argument("--resource-stats", help=("Count requests and bytes per page even with --resource-policy none, "
+                                                        "to compare policies. On with any other policy and with --debug."), action="store_true")
+    loading_group.add_argument("--resource-baseline", help=("JSON file of requests and bytes per page. Written by runs with --resource-policy none "
+                                                           "and --resource-stats, runs with a policy log what they saved compared to it."))
+
     scroll_group = parser.add_argument_group("scrolling related")
     scroll_group.add_argument("--scroll-load-time", "-s", help="Number of seconds (float). The higher, the stabler the fetch.", default=5, type=int)
+    scroll_group.add_argument("--scroll-wait", help=("How to wait for tweets after each scroll. "
+                                                    "fixed sleeps --scroll-load-time seconds. "
+                                                    "adaptive continues as soon as new tweets load, with --scroll-load-time as the ceiling."),
+                              choices=["fixed", "adaptive"], default="fixed")
     scroll_group.add_argument("--scroll-algorithm", help="Type of algorithm to calculate scroll offset.", choices=["percentile", "window", "constant"], default="window")
     scroll_group.add_argument("--scroll-value", default=5, type=float, help=("Value used by --scroll-algorithm."
                                                                         "If percentile, percentage of percentile calculated. "
@@ -65,6 +126,12 @@ def parse_args():
     group.add_argument("--url", "-u", help="Specify a profile url directly.")
 
     group.add_argument("--output_fpath", "-o", help="Output folder to generate results.", default="snapshots")
+
+    shard_group = parser.add_argument_group("multiple machines")
+    shard_group.add_argument("--shard", type=parse_shard, help=("Only crawl the i-th of N parts of --input-json, as i/N, counting from 0. "
+                                                               "Machines sharing the output folder never crawl a profile at the same time, "
+                                                               "and their reports are merged into report.json."))
+    shard_group.add_argument("--lease-ttl", help="Seconds (float) before the profile lease of a stopped machine can be taken over.", default=DEF_LEASE_TTL, type=float)
     return parser.parse_args()
 
 def main():
@@ -83,11 +150,36 @@ def main():
         "load_times": args.scroll_load_time,
         "number_posts_to_cap": args.posts,
         "fetch_threads": args.depth,
-        "num_threads": args.multi_threading
+        "num_threads": args.multi_threading,
+        "settings": CrawlSettings(
+            prune_dom=args.prune_dom,
+            ready_timeout=args.ready_timeout,
+            ready_quiet=args.ready_quiet,
+            ready_jitter=args.ready_jitter,
+            adaptive_scroll=args.scroll_wait == "adaptive",
+            scroll_algorithm=args.scroll_algorithm,
+            scroll_value=args.scroll_value,
+            incremental=args.incremental,
+            known_stop=args.known_stop,
+            screenshot_format=args.screenshot_format,
+            screenshot_writers=args.screenshot_writers,
+            screenshot_fsync=args.screenshot_fsync,
+            capture_mode=args.capture_mode,
+            pack=args.pack,
+            resource_policy=args.resource_policy or ("text" if args.bio_only else "none"),
+            blocked_urls=args.block_url,
+            resource_stats=args.resource_stats or args.debug or args.resource_baseline is not None,
+            resource_baseline=args.resource_baseline
+        )
     }
 
     assert args.depth >= 1, "You have to have atleast 1 depth in thread archiving."
+    assert args.tabs >= 1, "Each Chrome needs atleast 1 tab."
+    assert not (args.incremental and args.force), "--incremental updates outputs, --force deletes them. Pick one."
     assert (args.multi_threading == 1) or (args.multi_threading > 1 and not args.login), "Login feature only works on single thread."
+    assert args.workers_mode == "thread" or not args.login, "Login feature only works with thread workers."
+    assert args.workers_mode == "thread" or not args.frontier, "--frontier only works with thread workers."
+    assert not (args.pack and args.frontier), "--frontier crawls may span runs, pack them once done with bin/pack.py."
 
     args.output_fpath = args.output_fpath.strip()
 
@@ -97,46 +189,171 @@ def main():
 
     logger.debug("CLI Parsed: {}".format(extra_args))
 
+    settings = extra_args["settings"]
+    if args.index:
+        settings.index_db = os.path.join(args.output_fpath, INDEX_DB)
+        # Catch up with files written by runs without --index, then follow this one.
+        index = init_index(args.output_fpath, settings.index_db)
+        logger.info("Indexed {updated} changed of {files} files, dropped {removed} removed ones.".format(**index.index_tree()))
+
     # Select a scrolling algorithm before starting any drivers.
-    f = None
-    if args.scroll_algorithm == "percentile":
-        assert args.scroll_value <= 1.0 and args.scroll_value >= 0.0
-        f = calc_average_percentile(args.scroll_value)
-    elif args.scroll_algorithm == "window":
-        f = window_average(args.scroll_value)
-    else:
-        f = constant(args.scroll_value)
+    extra_args["offset_func"] = make_offset_func(args.scroll_algorithm, args.scroll_value)
+
+    BUDGET.configure(args.max_page_loads, args.max_wall_time)
+    set_resource_policy(settings.resource_policy, settings.blocked_urls, settings.resource_stats)
+    if args.screenshot_store:
+        settings.screenshot_store = os.path.join(args.output_fpath, BLOB_DIR)
+    SCREENSHOTS.configure(
+        settings.screenshot_writers,
+        image_format=settings.screenshot_format,
+        fsync=settings.screenshot_fsync,
+        store_dir=settings.screenshot_store)
+    leases = init_leases(args.output_fpath, args.lease_ttl) if args.shard else None
+    if args.workers_mode == "process":
+        try:
+            summaries = watch_processes(args, extra_args)
+        finally:
+            if leases is not None:
+                leases.shutdown()
+
+        report(args, summaries)
+        log_budget_report()
+        logger.info("ALL SNAPSHOTS COMPLETED!")
+        return
+
+    import_start = time.perf_counter()
+    import tb_watcher.core
+    from tb_watcher.readiness import log_ready_report
+    from tb_watcher.registry import log_visited_report
+    from tb_watcher.driver_utils import create_chrome_driver
+    from tb_watcher.driver_pool import init_driver_pool
+    from tb_watcher.threading import spawn_threads, shutdown_threads
+    logger.debug("Imported selenium in {:.2f}s.".format(time.perf_counter() - import_start))
+
+    resolve_start = time.perf_counter()
+    logger.debug("Using chromedriver: {}".format(resolve_chromedriver_path(args.chromedriver)))
+    logger.debug("Resolved chromedriver in {:.2f}s.".format(time.perf_counter() - resolve_start))
+
+    # Worker threads lease their drivers from the pool, launch them while the profile loads.
+    use_workers = args.multi_threading > 1
+    pool = init_driver_pool(
+        max(args.multi_threading - 1, 1),
+        max_pages=args.driver_recycle,
+        warm=use_workers and (args.depth > 1 or not args.url),
+        tabs=args.tabs)
+
+    spawn_threads(args.multi_threading, max_queued=args.queue_size)
 
-    extra_args["offset_func"] = f
+    # Profiles of --input-json run on the workers' drivers when there are workers.
+    driver = None
+    if (args.url and not args.frontier) or not use_workers:
+        driver = create_chrome_driver()
+    logger.info("Started in {:.2f}s.".format(time.perf_counter() - START_TIME))
 
-    driver = create_chrome_driver()
     if args.login:
         driver.get("https://twitter.com/login")
         input("Please logging then press any key in CLI to continue...")
 
-    data = []
+    try:
+        summaries = watch(driver, args, extra_args)
+        # Workers are daemons, on errors they die with the main thread instead.
+        shutdown_threads()
+    finally:
+        if driver is not None:
+            driver.quit()
+        pool.shutdown()
+        SCREENSHOTS.shutdown()
+        if leases is not None:
+            leases.shutdown()
+
+    report(args, summaries)
+    pool.log_stats()
+    log_screenshot_report()
+    log_resource_report(settings.resource_baseline)
+    log_ready_report()
+    log_visited_report()
+    log_budget_report()
+    logger.info("ALL SNAPSHOTS COMPLETED!")
+
+def load_following(fpath: str) -> List[dict]:
+    """Returns the accounts of a following list exported by Twitter."""
+    weird_opening = "window\..* = (\[[\S\s]*)"
+    with open(fpath) as f:
+        txt = f.read()
+        match = re.match(weird_opening, txt)
+
+        if match and match.group(1):
+            txt = match.group(1)
+
+        # Remove the first line metadata
+        data = json.loads(txt)
+
+    return [d["following"] for d in data]
+
+def load_urls(args: argparse.Namespace) -> List[str]:
+    """Returns --url, or the profiles of --input-json in the --shard of this machine."""
     if args.url:
-        logger.info("Watching: {}".format(args.url))
-        fetch_html(driver, args.url, fpath=args.output_fpath, **extra_args)
-    else:
-        weird_opening = "window\..* = (\[[\S\s]*)"
-        with open(args.input_json) as f:
-            txt = f.read()
-            match = re.match(weird_opening, txt)
+        return [args.url]
 
-            if match and match.group(1):
-                txt = match.group(1)
+    accounts = load_following(args.input_json)
+    urls = [a["userLink"] for a in accounts if in_shard(a.get("accountId", a["userLink"]), args.shard)]
+    if args.shard:
+        logger.info("Shard {}: {} of {} profiles.".format(args.shard, len(urls), len(accounts)))
+    return urls
 
-            # Remove the first line metadata
-            data = json.loads(txt)
+def watch(driver, args: argparse.Namespace, extra_args: dict) -> list:
+    """Snapshots the profile given by --url or every profile of --input-json. Returns their summaries."""
+    from tb_watcher.core import crawl_frontier, fetch_html, fetch_profiles
+    from tb_watcher.frontier import Frontier
 
-        for d in data:
-            account = d["following"]
-            url = account["userLink"]
-            logger.info("Watching: {}".format(url))
-            fetch_html(driver, url, fpath=args.output_fpath, **extra_args)
+    if args.frontier:
+        # Workers build their own scrolling function from the settings.
+        crawl_args = {k: v for k, v in extra_args.items() if k not in ("num_threads", "offset_func")}
+        return crawl_frontier(
+            Frontier(args.frontier),
+            load_urls(args),
+            driver,
+            num_workers=max(args.multi_threading - 1, 1),
+            fpath=args.output_fpath,
+            **crawl_args)
 
-    logger.info("ALL SNAPSHOTS COMPLETED!")
+    if args.url:
+        return [fetch_html(driver, args.url, fpath=args.output_fpath, **extra_args)]
+
+    profile_args = {k: v for k, v in extra_args.items() if k != "num_threads"}
+    return fetch_profiles(load_urls(args), driver, fpath=args.output_fpath, **profile_args)
+
+def report(args: argparse.Namespace, summaries: list):
+    """Logs the profile summaries. With --shard, also writes the report of this machine and merges all of them."""
+    from dataclasses import asdict
+    from tb_watcher.core import log_profile_summaries
+
+    log_profile_summaries(summaries)
+    if not args.shard:
+        return
+
+    write_shard_report(args.output_fpath, args.shard, [asdict(s) for s in summaries])
+    fpath, merged = merge_reports(args.output_fpath)
+    logger.info("Merged reports of shards {} into {}: {} profiles, {} tweets, {} failed, {} skipped.".format(
+        ", ".join(merged["shards"]), fpath, merged["profiles"], merged["tweets"], merged["failed"], merged["skipped"]))
+
+def watch_processes(args: argparse.Namespace, extra_args: dict) -> list:
+    """Snapshots profiles on worker processes, each launching its own Chrome. Returns their summaries."""
+    from tb_watcher.process_pool import ProcessCrawlPool
+
+    urls = load_urls(args)
+
+    # Workers build their own scrolling function from the settings.
+    crawl_args = {k: v for k, v in extra_args.items() if k not in ("num_threads", "offset_func")}
+    crawl_args["fpath"] = args.output_fpath
+    pool = ProcessCrawlPool(
+        args.multi_threading,
+        crawl_args,
+        chromedriver=resolve_chromedriver_path(args.chromedriver),
+        max_pages=args.driver_recycle,
+        job_timeout=args.job_timeout)
+    logger.info("Started in {:.2f}s.".format(time.perf_counter() - START_TIME))
+    return pool.run(urls)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,79 @@
+"""
+Crawl-wide budgets of page loads and wall time.
+Jobs are run shallowest first, so once a budget runs out the deepest levels are the ones left out.
+
+By: ProgrammingIncluded
+"""
+# std
+import time
+import threading
+
+from typing import Dict, Tuple
+
+# tb_watcher
+from tb_watcher.logger import logger
+
+class CrawlBudget:
+    """
+    Counts page loads and time spent since the crawl started.
+    A limit of 0 means unlimited.
+    """
+    def __init__(self, max_pages: int = 0, max_seconds: float = 0):
+        self.lock = threading.Lock()
+        self.configure(max_pages, max_seconds)
+
+    def configure(self, max_pages: int = 0, max_seconds: float = 0):
+        """Sets the limits and starts counting from now."""
+        with self.lock:
+            self.max_pages = max_pages
+            self.max_seconds = max_seconds
+            self.started = time.perf_counter()
+            self.pages = 0
+            # Jobs dropped because the budget ran out, per depth.
+            self.dropped: Dict[int, int] = {}
+
+    def charge_page(self, count: int = 1):
+        with self.lock:
+            self.pages += count
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def exhausted(self) -> bool:
+        with self.lock:
+            if self.max_pages and self.pages >= self.max_pages:
+                return True
+        return bool(self.max_seconds) and self.elapsed() >= self.max_seconds
+
+    def remaining(self) -> Tuple[int, float]:
+        """Pages and seconds left, 0 if unlimited. A running out limit leaves at least one page or a moment."""
+        with self.lock:
+            pages = max(self.max_pages - self.pages, 1) if self.max_pages else 0
+        seconds = max(self.max_seconds - self.elapsed(), 1e-3) if self.max_seconds else 0
+        return pages, seconds
+
+    def admits(self, depth: int) -> bool:
+        """Returns True if a job at depth may start, counting it as dropped otherwise."""
+        if not self.exhausted():
+            return True
+
+        with self.lock:
+            self.dropped[depth] = self.dropped.get(depth, 0) + 1
+        logger.debug("Crawl budget exhausted, dropping a job at depth {}.".format(depth))
+        return False
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "pages": self.pages,
+                "seconds": time.perf_counter() - self.started,
+                "dropped": dict(self.dropped),
+            }
+
+BUDGET = CrawlBudget()
+
+def log_budget_report():
+    report = BUDGET.report()
+    logger.info("Crawl loaded {} pages in {:.1f}s.".format(report["pages"], report["seconds"]))
+    for depth, count in sorted(report["dropped"].items()):
+        logger.info("Crawl budget ran out, dropped {} jobs at depth {}.".format(count, depth))
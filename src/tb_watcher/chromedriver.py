@@ -0,0 +1,91 @@
+"""
+Resolves the chromedriver binary once per process and caches it on disk across runs.
+By: ProgrammingIncluded
+"""
+# std
+import os
+import json
+import threading
+
+from typing import Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+
+# Takes precedence over any cached or downloaded chromedriver.
+CHROMEDRIVER_ENV = "TBW_CHROMEDRIVER"
+
+RESOLVE_LOCK = threading.Lock()
+RESOLVED_PATH = None
+
+def cache_fpath() -> str:
+    cache_root = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_root, "tb_watcher", "chromedriver.json")
+
+def detect_browser_version() -> Union[str, None]:
+    """Returns the installed Chrome version, or None if it cannot be detected."""
+    try:
+        from webdriver_manager.core.utils import ChromeType, get_browser_version_from_os
+        return get_browser_version_from_os(ChromeType.GOOGLE)
+    except Exception as e:
+        logger.debug("Unable to detect Chrome version: {}".format(e))
+        return None
+
+def load_cached_path(browser_version: Union[str, None]) -> Union[str, None]:
+    """Returns the cached chromedriver if it still exists and was resolved for the same Chrome version."""
+    try:
+        with open(cache_fpath(), encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not os.path.isfile(cached.get("path", "")):
+        return None
+
+    if browser_version is not None and cached.get("browser_version") != browser_version:
+        logger.debug("Chrome changed from {} to {}, resolving chromedriver again.".format(
+            cached.get("browser_version"), browser_version))
+        return None
+
+    return cached["path"]
+
+def save_cached_path(path: str, browser_version: Union[str, None]):
+    fpath = cache_fpath()
+    try:
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        tmp_fpath = "{}.{}.tmp".format(fpath, os.getpid())
+        with open(tmp_fpath, "w", encoding="utf-8") as f:
+            json.dump({"path": path, "browser_version": browser_version}, f)
+        os.replace(tmp_fpath, fpath)
+    except OSError as e:
+        logger.debug("Unable to cache chromedriver path: {}".format(e))
+
+def resolve_chromedriver_path(override: str = None) -> str:
+    """
+    Returns the chromedriver to use, resolving it only once per process.
+    Order: override, the TBW_CHROMEDRIVER environment variable, the on-disk cache,
+    then webdriver_manager which may download it.
+    """
+    global RESOLVED_PATH
+
+    with RESOLVE_LOCK:
+        override = override or os.environ.get(CHROMEDRIVER_ENV)
+        if override:
+            assert os.path.isfile(override), "chromedriver not found: {}".format(override)
+            RESOLVED_PATH = override
+
+        if RESOLVED_PATH is not None:
+            return RESOLVED_PATH
+
+        browser_version = detect_browser_version()
+        path = load_cached_path(browser_version)
+        if path is None:
+            # Heavy and needs network, only imported when the cache misses.
+            from webdriver_manager.chrome import ChromeDriverManager
+            path = ChromeDriverManager().install()
+            save_cached_path(path, browser_version)
+        else:
+            logger.debug("Using cached chromedriver: {}".format(path))
+
+        RESOLVED_PATH = path
+        return RESOLVED_PATH
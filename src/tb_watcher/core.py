@@ -3,19 +3,45 @@ Houses the main logic for fetching data and interfacing with Selenium.
 By: ProgrammingIncluded
 """
 # std
+import os
 import time
+import threading
 
-from typing import Callable
+from dataclasses import dataclass, replace
+from typing import Callable, List, Union
 
 # bluebird watcher
 from tb_watcher.logger import logger
 from tb_watcher.pages import TwitterBio
-from tb_watcher.threading import spawn_threads, threads_done, BUSY_LOCK, get_job, BUSY_THREADS
+from tb_watcher.driver_utils import record_page_resources
+from tb_watcher.settings import CrawlSettings
+from tb_watcher.budget import BUDGET
+from tb_watcher.pack import pack_folder
+from tb_watcher.screenshots import SCREENSHOTS
+from tb_watcher.math_utils import make_offset_func
+from tb_watcher.jobs import ProfileJob, ThreadJob, forward_thread_jobs
+from tb_watcher.frontier import DROPPED, FAILED, PENDING, Frontier, FrontierJob
+from tb_watcher.sharding import acquire_profile, release_profile
+from tb_watcher.driver_pool import get_driver_pool
+from tb_watcher.threading import JobGroup, add_job, job_group, spawn_threads, wait_for_jobs
 
 # selenium
 from selenium import webdriver
 
-def fetch_html(
+@dataclass(init=True, repr=True)
+class ProfileSummary:
+    """Outcome of snapshotting one profile, including the thread jobs it spawned."""
+    url: str
+    seconds: float = 0.0
+    tweets: int = 0
+    thread_jobs: int = 0
+    failures: int = 0
+    skipped: bool = False
+    error: Union[str, None] = None
+    # Folder the profile was archived to, None if it was not.
+    folder: Union[str, None] = None
+
+def fetch_profile(
     driver: webdriver,
     url: str,
     fpath: str,
@@ -25,30 +51,286 @@ def fetch_html(
     force: bool = False,
     number_posts_to_cap: int = 20,
     bio_only: bool = False,
-    num_threads: int = 4):
-    """Primary driver of the program."""
-
-    spawn_threads(num_threads)
+    settings: CrawlSettings = None) -> ProfileSummary:
+    """
+    Snapshots the bio and tweets of a profile.
+    Thread jobs are queued and may still be running when this returns.
+    """
+    summary = ProfileSummary(url)
 
     # We add one to the fetch_threads as we need to include the thread id themselves.
-    twitter_bio = TwitterBio(fpath, url, fetch_threads=fetch_threads, existing_driver=driver)
+    twitter_bio = TwitterBio(fpath, url, fetch_threads=fetch_threads, existing_driver=driver, settings=settings)
     twitter_bio.fetch_metadata()
     if not twitter_bio.write_json(force=force):
-        return
-    elif bio_only:
-        return
+        summary.skipped = True
+        return summary
+
+    summary.folder = twitter_bio.folder
+    if bio_only:
+        record_page_resources(driver, twitter_bio.page_type)
+        return summary
 
     # Create tweets folder
-    twitter_bio.fetch_tweets(
+    tweets = twitter_bio.fetch_tweets(
         number_posts_to_cap,
         load_times,
         offset_func,
     )
+    summary.tweets = len(tweets)
+    return summary
+
+def fetch_html(
+    driver: webdriver,
+    url: str,
+    fpath: str,
+    load_times: float,
+    offset_func: Callable,
+    fetch_threads: int,
+    force: bool = False,
+    number_posts_to_cap: int = 20,
+    bio_only: bool = False,
+    num_threads: int = 4,
+    settings: CrawlSettings = None) -> ProfileSummary:
+    """Primary driver of the program. Snapshots a profile and waits for all of its thread jobs."""
+
+    # Workers are only started once, later profiles reuse them.
+    spawn_threads(num_threads)
+
+    summaries = fetch_profiles(
+        [url],
+        driver,
+        fpath=fpath,
+        load_times=load_times,
+        offset_func=offset_func,
+        fetch_threads=fetch_threads,
+        force=force,
+        number_posts_to_cap=number_posts_to_cap,
+        bio_only=bio_only,
+        settings=settings)
+    logger.info("All jobs finished!")
+    return summaries[0]
+
+def pack_profile(folder: Union[str, None], settings: Union[CrawlSettings, None]):
+    """Packs the folder of a finished profile if packing is enabled, once its screenshots are written."""
+    if folder is None or settings is None or not settings.pack:
+        return
+
+    SCREENSHOTS.wait_for(folder)
+    try:
+        stats = pack_folder(folder)
+    except Exception as e:
+        logger.error("Unable to pack {}, keeping the folder: {}".format(folder, e))
+        return
+    logger.info("Packed {} files, {:.1f}MB, of {}.".format(stats["files"], stats["bytes"] / 1e6, folder))
+
+def fetch_profiles(urls: List[str], driver: webdriver = None, **kwargs) -> List[ProfileSummary]:
+    """
+    Snapshots every profile as a job of its own.
+    If driver is given, profiles run one after another on this thread with it.
+    Otherwise they are spread over the worker threads, each leasing a driver from the pool.
+    Blocks until every profile and thread job is done.
+
+    Returns:
+        [ProfileSummary]: One summary per url, in order.
+    """
+    scheduled = []
+    for i, url in enumerate(urls):
+        summary = ProfileSummary(url)
+        group = JobGroup()
+        # Time waiting in the queue is not part of a profile, so it starts with its job.
+        started = []
+
+        def _profile(_: bool, url=url, summary=summary, started=started):
+            if not BUDGET.admits(0):
+                summary.skipped = True
+                return
+
+            # Another node may be crawling it.
+            if not acquire_profile(url):
+                summary.skipped = True
+                return
+
+            started.append(time.perf_counter())
+            logger.info("Watching: {}".format(url))
+            try:
+                if driver is not None:
+                    result = fetch_profile(driver, url, **kwargs)
+                else:
+                    with get_driver_pool().leased() as new_driver:
+                        result = fetch_profile(new_driver, url, **kwargs)
+            except Exception as e:
+                summary.error = str(e)
+                raise
+
+            summary.tweets = result.tweets
+            summary.skipped = result.skipped
+            summary.folder = result.folder
+
+        with job_group(group):
+            # Profiles go before any thread, in order of the list.
+            priority = (0, i)
+            scheduled.append((summary, group, started, add_job(_profile, inline=driver is not None, priority=priority)))
+        # The lease is kept until the thread jobs of the profile are done as well, and so is its folder.
+        def _done(url=url, summary=summary):
+            pack_profile(summary.folder, kwargs.get("settings"))
+            release_profile(url)
+        group.when_done(_done)
+
+    wait_for_jobs()
+
+    results = []
+    for summary, group, started, future in scheduled:
+        # The profile job itself is part of its group.
+        summary.thread_jobs = group.num_jobs() - 1
+        summary.failures = group.failures
+        if started and group.finished_at is not None:
+            summary.seconds = group.finished_at - started[0]
+        results.append(summary)
+    return results
+
+def frontier_summaries(frontier: Frontier, urls: List[str]) -> List[ProfileSummary]:
+    """
+    Builds the summary of every profile from the jobs stored in the frontier, including those of earlier runs.
+    Profiles left pending, e.g. once the budget ran out, are skipped.
+    """
+    summaries = []
+    for url in urls:
+        summary = ProfileSummary(url)
+        rows = frontier.profile_rows(url)
+        for row in rows:
+            if row["kind"] == "profile":
+                summary.tweets = row["tweets"] or 0
+                summary.error = row["error"] if row["status"] == FAILED else None
+                summary.skipped = row["status"] in (PENDING, DROPPED)
+            else:
+                summary.thread_jobs += 1
+                summary.failures += row["status"] == FAILED
+
+        started = [r["started_at"] for r in rows if r["started_at"] is not None]
+        finished = [r["finished_at"] for r in rows if r["finished_at"] is not None]
+        if started and finished:
+            summary.seconds = max(finished) - min(started)
+        summaries.append(summary)
+    return summaries
+
+def run_frontier_job(claimed: FrontierJob, driver: webdriver, **kwargs) -> int:
+    """Runs a job claimed from the frontier with driver. Returns the number of tweets of profiles."""
+    job = claimed.job
+    settings = kwargs["settings"] or CrawlSettings()
+    # A retried job keeps what an earlier attempt archived and fetches the rest.
+    if claimed.attempts > 1:
+        settings = replace(settings, incremental=True, known_stop=0)
+    offset_func = make_offset_func(settings.scroll_algorithm, settings.scroll_value)
+
+    if isinstance(job, ProfileJob):
+        profile_args = dict(kwargs, settings=settings, offset_func=offset_func)
+        return fetch_profile(driver, job.url, **profile_args).tweets
+
+    replace(job, settings=settings).run(driver, offset_func)
+    return None
+
+def crawl_frontier(frontier: Frontier, urls: List[str], driver: webdriver = None, num_workers: int = 1, **kwargs) -> List[ProfileSummary]:
+    """
+    Snapshots every profile through the frontier, resuming the jobs of an interrupted crawl.
+    Thread jobs are added to the frontier instead of the executor. Workers claim jobs until
+    no job is left in any process sharing the frontier.
+    If driver is given, a single worker runs on this thread with it.
+    Otherwise num_workers worker threads each lease a driver from the pool per job.
+
+    Returns:
+        [ProfileSummary]: One summary per url, in order, including jobs of earlier runs.
+    """
+    released = frontier.recover()
+    if released:
+        logger.info("Resuming {} jobs left running by an interrupted crawl.".format(released))
+
+    for i, url in enumerate(urls):
+        frontier.add("profile:{}".format(url), ProfileJob(url), 0, i, url)
+    logger.info("Frontier: {}".format(frontier.counts()))
+
+    # Thread jobs inherit the profile of the job spawning them.
+    local = threading.local()
+    def _forward(job: ThreadJob):
+        key = job.metadata.id if job.metadata is not None else job.url
+        frontier.add("thread:{}".format(key), job, job.depth, local.claimed.profile, local.claimed.profile_url,
+                     os.path.basename(job.root_dir))
+    forward_thread_jobs(_forward)
+
+    # Profiles another node holds the lease of, left pending for a later crawl.
+    contended = set()
+    def _worker(_: bool):
+        while True:
+            # Jobs left over stay pending, so a later crawl resumes them.
+            if BUDGET.exhausted():
+                return
+
+            claimed = frontier.claim(contended)
+            if claimed is None:
+                # Other workers may still add thread jobs.
+                if frontier.unfinished(contended) == 0:
+                    return
+                time.sleep(1.0)
+                continue
+
+            if not BUDGET.admits(claimed.depth):
+                frontier.release(claimed)
+                return
+
+            is_profile = isinstance(claimed.job, ProfileJob)
+            if is_profile and not acquire_profile(claimed.job.url):
+                logger.info("Profile {} is being crawled elsewhere, leaving it for later.".format(claimed.job.url))
+                contended.add(claimed.id)
+                frontier.release(claimed)
+                continue
+
+            local.claimed = claimed
+            logger.info("Running {} job: {}".format(claimed.kind, claimed.job.url))
+            try:
+                if driver is not None:
+                    tweets = run_frontier_job(claimed, driver, **kwargs)
+                else:
+                    with get_driver_pool().leased() as new_driver:
+                        tweets = run_frontier_job(claimed, new_driver, **kwargs)
+            except Exception as e:
+                logger.exception("Job failed: {}".format(e))
+                frontier.complete(claimed, error=str(e))
+            else:
+                frontier.complete(claimed, tweets=tweets)
+            finally:
+                # Its thread jobs are in the frontier, which only hands each to one worker.
+                if is_profile:
+                    release_profile(claimed.job.url)
+
+    frontier.start_heartbeat()
+    try:
+        if driver is not None:
+            _worker(False)
+        else:
+            for _ in range(num_workers):
+                add_job(_worker)
+            wait_for_jobs()
+    finally:
+        frontier.stop_heartbeat()
+        forward_thread_jobs(None)
+
+    logger.info("Frontier: {}".format(frontier.counts()))
+    return frontier_summaries(frontier, urls)
 
-    driver.close()
-    # Wait for any remaining pending jobs
-    while not threads_done():
-        time.sleep(1)
+def log_profile_summaries(summaries: List[ProfileSummary]):
+    """Logs one line per profile and totals."""
+    for s in summaries:
+        if s.error is not None:
+            status = "FAILED ({})".format(s.error)
+        elif s.skipped:
+            status = "skipped"
+        else:
+            status = "ok"
+        logger.info("{}: {}, {:.1f}s, {} tweets, {} thread jobs, {} failures.".format(
+            s.url, status, s.seconds, s.tweets, s.thread_jobs, s.failures))
 
-    # Daemon threads will terminate when main thread is terminated.
-    logger.info("All jobs finished! Terminating main thread.")
+    logger.info("{} profiles, {} tweets, {} thread jobs, {} failures in {:.1f}s of profile time.".format(
+        len(summaries),
+        sum(s.tweets for s in summaries),
+        sum(s.thread_jobs for s in summaries),
+        sum(s.failures for s in summaries),
+        sum(s.seconds for s in summaries)))
@@ -0,0 +1,461 @@
+"""
+Pool of warm Chrome drivers, or tabs of them, shared by worker threads.
+By: ProgrammingIncluded
+"""
+# std
+import copy
+import math
+import time
+import threading
+
+from contextlib import contextmanager
+from typing import Callable, List, Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.driver_utils import BLANK_URL, apply_resource_policy, command_counter, create_chrome_driver
+
+# selenium
+from selenium import webdriver
+from selenium.webdriver.remote.command import Command
+from selenium.webdriver.remote.switch_to import SwitchTo
+
+# Keeps Chrome from throttling the tabs of other slots while they are in the background.
+TAB_CHROME_ARGUMENTS = [
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+]
+
+SLOT_MEMORY_SCRIPT = "return window.performance.memory ? window.performance.memory.usedJSHeapSize : null;"
+
+
+class DriverPool:
+    """
+    Leases Chrome drivers to jobs and takes them back once done.
+    Drivers are reset between jobs, health-checked before each lease and
+    recycled after max_pages page loads or when they crash.
+    """
+    def __init__(self, size: int, factory: Callable[[], webdriver], max_pages: int = 50):
+        assert size >= 1, "A pool needs room for atleast one driver."
+        self.size = size
+        self.factory = factory
+        self.max_pages = max_pages
+
+        self.cond = threading.Condition()
+        self.idle: List[webdriver] = []
+        # Drivers alive or being launched, never above size.
+        self.total = 0
+        self.closed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.launches = 0
+        self.launch_seconds = 0.0
+        self.recycled = 0
+        self.crashed = 0
+
+    def warm_up(self, count: int = None):
+        """Launches up to count drivers in the background so the first leases are hits."""
+        with self.cond:
+            count = min(self.size if count is None else count, self.size - self.total)
+            self.total += max(count, 0)
+
+        def _warm():
+            try:
+                driver = self.launch()
+            except Exception as e:
+                logger.warning("Unable to warm up a driver: {}".format(e))
+                with self.cond:
+                    self.total -= 1
+                    self.cond.notify()
+                return
+
+            with self.cond:
+                self.idle.append(driver)
+                self.cond.notify()
+
+        for _ in range(count):
+            threading.Thread(target=_warm, daemon=True).start()
+
+    def launch(self) -> webdriver:
+        start = time.perf_counter()
+        driver = self.factory()
+        elapsed = time.perf_counter() - start
+        with self.cond:
+            self.launches += 1
+            self.launch_seconds += elapsed
+        logger.debug("Launched a driver in {:.2f}s.".format(elapsed))
+        return driver
+
+    def lease(self) -> webdriver:
+        """Returns a healthy driver, launching one if none are idle. Blocks if the pool is full."""
+        while True:
+            launch = False
+            with self.cond:
+                while not self.idle and self.total >= self.size:
+                    assert not self.closed, "Driver pool is closed."
+                    self.cond.wait()
+
+                if self.idle:
+                    driver = self.idle.pop()
+                else:
+                    self.total += 1
+                    launch = True
+
+            if launch:
+                try:
+                    driver = self.launch()
+                except Exception:
+                    with self.cond:
+                        self.total -= 1
+                        self.cond.notify()
+                    raise
+
+                with self.cond:
+                    self.misses += 1
+                return driver
+
+            if self.is_healthy(driver):
+                with self.cond:
+                    self.hits += 1
+                return driver
+
+            logger.debug("Idle driver failed health check, replacing it.")
+            self.discard(driver, crashed=True)
+
+    def release(self, driver: webdriver):
+        """Returns a driver to the pool, recycling it if it has crashed or loaded too many pages."""
+        if self.max_pages and command_counter(driver).pages >= self.max_pages:
+            logger.debug("Driver reached {} pages, recycling.".format(self.max_pages))
+            self.discard(driver)
+            return
+
+        try:
+            reset_driver(driver)
+        except Exception as e:
+            logger.debug("Unable to reset driver, recycling: {}".format(e))
+            self.discard(driver, crashed=True)
+            return
+
+        with self.cond:
+            if self.closed:
+                self.total -= 1
+            else:
+                self.idle.append(driver)
+                driver = None
+            self.cond.notify()
+
+        if driver is not None:
+            quit_driver(driver)
+
+    def discard(self, driver: webdriver, crashed: bool = False):
+        quit_driver(driver)
+        with self.cond:
+            self.total -= 1
+            if crashed:
+                self.crashed += 1
+            else:
+                self.recycled += 1
+            self.cond.notify()
+
+    @contextmanager
+    def leased(self):
+        """Context manager leasing a driver for the duration of a job."""
+        driver = self.lease()
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+
+    def is_healthy(self, driver: webdriver) -> bool:
+        try:
+            return driver.execute_script("return 1;") == 1
+        except Exception:
+            return False
+
+    def shutdown(self):
+        """Quits every idle driver, leased drivers are quit once released."""
+        with self.cond:
+            self.closed = True
+            drivers, self.idle = self.idle, []
+            self.total -= len(drivers)
+            self.cond.notify_all()
+
+        for driver in drivers:
+            quit_driver(driver)
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "launches": self.launches,
+                "mean_launch_seconds": self.launch_seconds / self.launches if self.launches else 0.0,
+                "recycled": self.recycled,
+                "crashed": self.crashed,
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info("Driver pool: {} hits, {} misses, {} launches ({:.2f}s mean), {} recycled, {} crashed.".format(
+            stats["hits"], stats["misses"], stats["launches"], stats["mean_launch_seconds"],
+            stats["recycled"], stats["crashed"]))
+
+class TabBrowser:
+    """
+    A browser whose tabs are handed out as slots, each driven like a browser of its own.
+    WebDriver commands always go to the current tab, so every command of a slot
+    takes the browser's lock and switches to the slot's tab first if needed.
+    """
+    def __init__(self, driver: webdriver):
+        self.driver = driver
+        self.lock = threading.RLock()
+        # Sends a command without switching tabs, still counted by the driver's counter.
+        # The counter goes in first, slots would bypass one installed after this.
+        command_counter(driver)
+        self.execute = driver.execute
+        self.current = driver.current_window_handle
+
+        # Slots leased, guarded by the pool.
+        self.active = 0
+        self.draining = False
+        self.crashed = False
+
+    def open_slot(self) -> webdriver:
+        """Opens a tab and returns a driver sending its commands to it."""
+        with self.lock:
+            handle = self.execute(Command.NEW_WINDOW, {"type": "tab"})["value"]["handle"]
+
+        slot = copy.copy(self.driver)
+        slot.tbw_tab_browser = self
+        slot.tbw_tab_handle = handle
+
+        def _execute(driver_command, params=None):
+            with self.lock:
+                if driver_command == Command.SWITCH_TO_WINDOW:
+                    # The slot moves to the tab it switches to, e.g. a tab it opened itself.
+                    slot.tbw_tab_handle = params["handle"]
+                elif self.current != slot.tbw_tab_handle:
+                    self.execute(Command.SWITCH_TO_WINDOW, {"handle": slot.tbw_tab_handle})
+                self.current = slot.tbw_tab_handle
+
+                try:
+                    return self.execute(driver_command, params)
+                finally:
+                    if driver_command == Command.CLOSE:
+                        self.current = None
+
+        # Elements found by the slot send their commands through it as well.
+        slot.execute = _execute
+        slot._switch_to = SwitchTo(slot)
+        apply_resource_policy(slot)
+        return slot
+
+    def close_slot(self, slot: webdriver) -> Union[int, None]:
+        """Closes the tab of a slot. Returns the JS heap size of the tab in bytes, if Chrome reports it."""
+        memory = None
+        try:
+            memory = slot.execute_script(SLOT_MEMORY_SCRIPT)
+        except Exception as e:
+            logger.debug("Unable to read slot memory: {}".format(e))
+
+        with self.lock:
+            # The slot may have closed its tab already, never close the browser's first window.
+            handles = self.execute(Command.W3C_GET_WINDOW_HANDLES)["value"]
+            if slot.tbw_tab_handle in handles[1:]:
+                slot.close()
+        return memory
+
+class TabPool:
+    """
+    Leases tabs instead of whole browsers, hosting up to tabs slots per browser
+    so more jobs run at once for the memory of a single Chrome.
+    Browsers come from a DriverPool and go back to it once their last slot is released,
+    which resets or recycles them as usual. A browser past max_pages stops taking slots.
+    """
+    def __init__(self, size: int, tabs: int, factory: Callable[[], webdriver], max_pages: int = 50):
+        assert tabs >= 1, "A browser needs room for atleast one tab."
+        self.size = size
+        self.tabs = tabs
+        self.max_pages = max_pages
+        self.pool = DriverPool(math.ceil(size / tabs), factory, max_pages=max_pages)
+
+        self.cond = threading.Condition()
+        self.browsers: List[TabBrowser] = []
+        self.launching = 0
+        self.closed = False
+
+        self.slots = 0
+        self.peak_active = 0
+        self.memory_samples: List[int] = []
+
+    def warm_up(self, count: int = None):
+        self.pool.warm_up(count)
+
+    def lease_browser(self) -> TabBrowser:
+        """Returns a browser with a free slot, taken by the caller. Blocks if every browser is full."""
+        with self.cond:
+            while True:
+                assert not self.closed, "Driver pool is closed."
+                free = [b for b in self.browsers if b.active < self.tabs and not b.draining]
+                if free:
+                    # Fill busy browsers first so idle ones can be recycled.
+                    browser = max(free, key=lambda b: b.active)
+                    browser.active += 1
+                    return browser
+
+                if len(self.browsers) + self.launching < self.pool.size:
+                    self.launching += 1
+                    break
+                self.cond.wait()
+
+        try:
+            browser = TabBrowser(self.pool.lease())
+        finally:
+            with self.cond:
+                self.launching -= 1
+                self.cond.notify_all()
+
+        with self.cond:
+            browser.active += 1
+            self.browsers.append(browser)
+        return browser
+
+    def lease(self) -> webdriver:
+        """Returns a driver for a new tab of a pooled browser."""
+        browser = self.lease_browser()
+        try:
+            slot = browser.open_slot()
+        except Exception:
+            browser.crashed = True
+            self.release_browser(browser)
+            raise
+
+        with self.cond:
+            self.slots += 1
+            self.peak_active = max(self.peak_active, sum(b.active for b in self.browsers))
+        return slot
+
+    def release(self, slot: webdriver):
+        browser = slot.tbw_tab_browser
+        try:
+            memory = browser.close_slot(slot)
+        except Exception as e:
+            logger.debug("Unable to close slot, recycling its browser: {}".format(e))
+            browser.crashed = True
+            memory = None
+
+        with self.cond:
+            if memory is not None:
+                self.memory_samples.append(memory)
+        self.release_browser(browser)
+
+    def release_browser(self, browser: TabBrowser):
+        """Gives up a slot of browser, returning the browser to the pool once it is unused and draining."""
+        with self.cond:
+            browser.active -= 1
+            if browser.crashed or (self.max_pages and command_counter(browser.driver).pages >= self.max_pages):
+                browser.draining = True
+
+            done = browser.active == 0 and (browser.draining or self.closed)
+            if done:
+                self.browsers.remove(browser)
+            self.cond.notify_all()
+
+        if not done:
+            return
+
+        if browser.crashed:
+            self.pool.discard(browser.driver, crashed=True)
+        else:
+            self.pool.release(browser.driver)
+
+    @contextmanager
+    def leased(self):
+        """Context manager leasing a tab for the duration of a job."""
+        slot = self.lease()
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def shutdown(self):
+        """Returns every unused browser and quits them, browsers in use are quit once their slots are released."""
+        with self.cond:
+            self.closed = True
+            unused = [b for b in self.browsers if b.active == 0]
+            for browser in unused:
+                self.browsers.remove(browser)
+            self.cond.notify_all()
+
+        for browser in unused:
+            self.pool.release(browser.driver)
+        self.pool.shutdown()
+
+    def stats(self) -> dict:
+        stats = self.pool.stats()
+        with self.cond:
+            samples = self.memory_samples
+            stats.update({
+                "tabs": self.tabs,
+                "slots": self.slots,
+                "peak_active_slots": self.peak_active,
+                "mean_slot_bytes": sum(samples) / len(samples) if samples else 0.0,
+                "peak_slot_bytes": max(samples) if samples else 0,
+            })
+        return stats
+
+    def log_stats(self):
+        self.pool.log_stats()
+        stats = self.stats()
+        logger.info("Tabs: {} slots at up to {} per browser, {} active at most, {:.1f}MB mean and {:.1f}MB peak JS heap per slot.".format(
+            stats["slots"], stats["tabs"], stats["peak_active_slots"],
+            stats["mean_slot_bytes"] / 2**20, stats["peak_slot_bytes"] / 2**20))
+
+def reset_driver(driver: webdriver):
+    """Closes every window but one and leaves it blank, keeping cookies so logins survive."""
+    handles = driver.window_handles
+    for handle in handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+
+    driver.switch_to.window(handles[0])
+    driver.get(BLANK_URL)
+
+def quit_driver(driver: webdriver):
+    try:
+        driver.quit()
+    except Exception as e:
+        logger.debug("Unable to quit driver: {}".format(e))
+
+DRIVER_POOL = None
+DRIVER_POOL_LOCK = threading.Lock()
+
+def init_driver_pool(size: int, max_pages: int = 50, warm: bool = False, tabs: int = 1) -> Union[DriverPool, TabPool]:
+    """
+    Creates the pool shared by worker threads, replacing any previous one.
+    With more than one tab, size slots are spread over browsers hosting tabs slots each.
+    """
+    global DRIVER_POOL
+    with DRIVER_POOL_LOCK:
+        if DRIVER_POOL is not None:
+            DRIVER_POOL.shutdown()
+
+        if tabs > 1:
+            DRIVER_POOL = TabPool(size, tabs, lambda: create_chrome_driver(TAB_CHROME_ARGUMENTS), max_pages=max_pages)
+        else:
+            DRIVER_POOL = DriverPool(size, create_chrome_driver, max_pages=max_pages)
+        pool = DRIVER_POOL
+
+    if warm:
+        pool.warm_up()
+    return pool
+
+def get_driver_pool() -> Union[DriverPool, TabPool]:
+    """Returns the shared pool, creating a single driver pool if none was initialized."""
+    global DRIVER_POOL
+    with DRIVER_POOL_LOCK:
+        if DRIVER_POOL is None:
+            DRIVER_POOL = DriverPool(1, create_chrome_driver)
+        return DRIVER_POOL
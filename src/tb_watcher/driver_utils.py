@@ -5,29 +5,67 @@ By: ProgrammingIncluded
 
 # std
 import os
+import re
 import time
-import json
 import random
+import contextlib
 from abc import abstractmethod
 
-from typing import Callable, List, Union
+from typing import Callable, Dict, List, Tuple, Union
 from dataclasses import dataclass, asdict
+from urllib.parse import urljoin, urlparse
 
 # tb_watcher
 from tb_watcher.logger import logger
-from tb_watcher.threading import add_job
+from tb_watcher.settings import CrawlSettings
+from tb_watcher.registry import VISITED
+from tb_watcher.budget import BUDGET
+from tb_watcher.storage import TweetStream, compact_tweet_stream, load_known_tweets
+from tb_watcher.screenshots import pillow_available, save_screenshot
+from tb_watcher.resources import count_log_entries, get_resource_policy, record_resources
+from tb_watcher.readiness import POLL_INTERVAL, RESOURCE_COUNT_EXPRESSION, SCROLL_LATENCY
+from tb_watcher.chromedriver import resolve_chromedriver_path
 
 # selenium
 import selenium
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.common.by import By
+from selenium.webdriver.remote.command import Command
 from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
 
 DEF_WINDOW_SIZE = (800, 1440)
+STATUS_PATH_RE = re.compile(r"^/([A-Za-z0-9_]+)/status/(\d+)")
+
+# Loaded by reset_driver(), not counted as a page.
+BLANK_URL = "about:blank"
+
+class CommandCounter:
+    """
+    Counts the commands a driver sends, each command being one WebDriver round-trip.
+    Page loads are counted separately as well, leaving out blank pages loaded to reset the driver.
+    """
+    def __init__(self, driver: webdriver):
+        self.count = 0
+        self.pages = 0
+        execute = driver.execute
+
+        def _execute(driver_command, *args, **kwargs):
+            self.count += 1
+            params = args[0] if args else kwargs.get("params")
+            if driver_command == Command.GET and (params or {}).get("url") != BLANK_URL:
+                self.pages += 1
+            return execute(driver_command, *args, **kwargs)
+
+        # Elements send their commands through the driver as well.
+        driver.execute = _execute
+
+def command_counter(driver: webdriver) -> CommandCounter:
+    """Returns the command counter of a driver, installing one if needed."""
+    counter = getattr(driver, "tbw_command_counter", None)
+    if counter is None:
+        counter = CommandCounter(driver)
+        driver.tbw_command_counter = counter
+    return counter
 
 def ensures_or(f: str, otherwise: str = "NULL"):
     try:
@@ -59,9 +97,11 @@ class Tweet(Unique):
     reply_count: str
     potential_boost: bool
     parent_id: Union[str, None]
+    # ISO time of the tweet, timestamp is only the text shown such as "3h" or "Nov 25".
+    datetime: Union[str, None] = None
 
     def get_url(self):
-        return "https://www.twitter.com/{clean_handle}/status/{id}".format(self.handle[1:], self.id)
+        return "https://www.twitter.com/{}/status/{}".format(self.handle[1:], self.id)
 
     def unique_id(self):
         """Used for folder writing."""
@@ -82,13 +122,105 @@ class BioMetadata(Unique):
         """Used for folder writing."""
         return self.username[1:]
 
+@dataclass(init=True, repr=True)
+class Permalink:
+    """Status link of a tweet as rendered on a timeline."""
+    id: str
+    handle: str
+    url: str
+
 class MaxCapturesReached(RuntimeError):
     """The specified number of captures have been reached."""
 
-def tweet_dom_get_basic_metadata(tweet_dom):
-    """Retrieves all metadata from tweet dom except unique id."""
+class KnownTweetsReached(MaxCapturesReached):
+    """Enough archived tweets in a row have been seen, the rest of the page is archived already."""
+
+@dataclass(init=True, repr=True)
+class TweetDom:
+    """A tweet node of the page along with the fields read from it in bulk."""
+    element: object
+    div_id: str
+    tweet: Tweet
+    permalink: Union[Permalink, None]
+    # Joined by a line to the tweet above it, which it replies to.
+    connected: bool = False
+    # Status link of the tweet above, if connected.
+    parent: Union[Permalink, None] = None
+
+# Attribute set on tweet nodes once they have been processed.
+SEEN_ATTRIBUTE = "data-tbw-seen"
+
+# Reads every field needed for a Tweet from a list of tweet nodes in a single call.
+# If no nodes are given, every tweet node in the document is used, or only
+# the ones not processed yet if the second argument is set.
+TWEET_FIELDS_SCRIPT = """
+    const text = (root, selector) => {
+        const element = root.querySelector(selector);
+        return element ? element.innerText : null;
+    };
+    const statusHref = tweet => {
+        const time = tweet.querySelector('a[href*="/status/"] time');
+        const anchor = time ? time.closest('a') : tweet.querySelector('a[href*="/status/"]');
+        return anchor ? anchor.getAttribute('href') : null;
+    };
+    // Replies shown under the tweet they answer have a thin line running down to their avatar.
+    const connected = tweet => {
+        const avatar = tweet.querySelector('[data-testid="Tweet-User-Avatar"]');
+        if (!avatar)
+            return false;
+        const a = avatar.getBoundingClientRect();
+        const center = (a.left + a.right) / 2;
+        return Array.from(tweet.querySelectorAll('div')).some(line => {
+            const r = line.getBoundingClientRect();
+            return r.width > 0 && r.width <= 4 && r.height > 0 && r.bottom <= a.top + 1 &&
+                Math.abs((r.left + r.right) / 2 - center) <= 2;
+        });
+    };
+    const selector = arguments[1] ? '[data-testid="tweet"]:not([%s])' : '[data-testid="tweet"]';
+    const nodes = arguments[0] || Array.from(document.querySelectorAll(selector));
+    const all = Array.from(document.querySelectorAll('[data-testid="tweet"]'));
+    const order = new Map(all.map((tweet, i) => [tweet, i]));
+    return nodes.map(tweet => {
+        const time = tweet.querySelector('a[href*="/status/"] time');
+        const isConnected = connected(tweet);
+        const above = isConnected && order.get(tweet) > 0 ? all[order.get(tweet) - 1] : null;
+        return {
+            element: tweet,
+            div_id: tweet.getAttribute('aria-labelledby'),
+            tag_text: text(tweet, 'div[data-testid="User-Names"]'),
+            tweet_text: text(tweet, 'div[data-testid="tweetText"]'),
+            retweet_count: text(tweet, 'div[data-testid="retweet"]'),
+            like_count: text(tweet, 'div[data-testid="like"]'),
+            reply_count: text(tweet, 'div[data-testid="reply"]'),
+            href: statusHref(tweet),
+            datetime: time ? time.getAttribute('datetime') : null,
+            connected: isConnected,
+            parent_href: above ? statusHref(above) : null
+        };
+    });
+""" % SEEN_ATTRIBUTE
+
+def permalink_from_href(href: Union[str, None]) -> Union[Permalink, None]:
+    """Parses a status link, returns None if it is not one."""
+    if not href:
+        return None
+
+    match = STATUS_PATH_RE.match(urlparse(href).path)
+    if match is None:
+        logger.debug("Unrecognized status link: {}".format(href))
+        return None
+
+    handle, tweet_id = match.groups()
+    return Permalink(tweet_id, "@{}".format(handle), urljoin("https://twitter.com", match.group(0)))
+
+def tweet_from_fields(fields: dict) -> Tweet:
+    """Creates a Tweet without unique id from the fields of TWEET_FIELDS_SCRIPT."""
+    def _or_null(key):
+        value = fields.get(key)
+        return "NULL" if value is None else value
+
     tm = {"id": "null", "parent_id": None}
-    tm["tag_text"] = ensures_or(lambda: tweet_dom.find_element(By.CSS_SELECTOR,'div[data-testid="User-Names"]').text)
+    tm["tag_text"] = _or_null("tag_text")
     try:
         splts = str(tm["tag_text"]).split("\n")
         if len(splts) == 2:
@@ -99,20 +231,128 @@ def tweet_dom_get_basic_metadata(tweet_dom):
     except Exception as e:
         tm["name"], tm["handle"], tm["timestamp"] = tm["tag_text"], "ERR", "ERR"
 
-    tm["tweet_text"] = ensures_or(lambda: tweet_dom.find_element(By.CSS_SELECTOR,'div[data-testid="tweetText"]').text)
-    tm["retweet_count"] = ensures_or(lambda: tweet_dom.find_element(By.CSS_SELECTOR,'div[data-testid="retweet"]').text)
-    tm["like_count"] = ensures_or(lambda: tweet_dom.find_element(By.CSS_SELECTOR,'div[data-testid="like"]').text)
-    tm["reply_count"] = ensures_or(lambda: tweet_dom.find_element(By.CSS_SELECTOR,'div[data-testid="reply"]').text)
+    tm["tweet_text"] = _or_null("tweet_text")
+    tm["retweet_count"] = _or_null("retweet_count")
+    tm["like_count"] = _or_null("like_count")
+    tm["reply_count"] = _or_null("reply_count")
     tm["potential_boost"] = False
+    tm["datetime"] = fields.get("datetime")
     return Tweet(**tm)
 
+def bulk_tweet_dom_get_metadata(driver: webdriver, tweet_doms: List = None, unseen_only: bool = False) -> List[TweetDom]:
+    """
+    Retrieves the metadata of several tweet doms in one round-trip.
+    If tweet_doms is not given, all tweets of the page are used.
+    unseen_only limits those to tweets not yet marked by mark_tweet_doms_seen().
+    """
+    results = driver.execute_script(TWEET_FIELDS_SCRIPT, tweet_doms, unseen_only)
+    return [
+        TweetDom(
+            r["element"], r["div_id"], tweet_from_fields(r), permalink_from_href(r["href"]),
+            r["connected"], permalink_from_href(r["parent_href"]))
+        for r in results
+    ]
+
+def mark_tweet_doms_seen(driver: webdriver, tweet_doms: List):
+    """Tags tweet doms as processed so later bulk queries can skip them."""
+    if tweet_doms:
+        driver.execute_script("arguments[0].forEach(t => t.setAttribute('{}', '1'));".format(SEEN_ATTRIBUTE), tweet_doms)
+
+def prune_seen_tweet_doms(driver: webdriver, margin: float = 2.0) -> int:
+    """
+    Empties processed tweets which are more than margin viewports above the current scroll.
+    Their cells keep their height so scroll offsets stay valid.
+    Returns the number of tweets pruned.
+    """
+    return driver.execute_script("""
+        const limit = -arguments[0] * window.innerHeight;
+        let pruned = 0;
+        document.querySelectorAll('[data-testid="tweet"][%s]').forEach(tweet => {
+            if (tweet.getBoundingClientRect().bottom >= limit)
+                return;
+
+            const cell = tweet.closest('[data-testid="cellInnerDiv"]') || tweet.parentNode;
+            cell.style.minHeight = cell.offsetHeight + 'px';
+            // Drop media first so decoded frames are released.
+            cell.querySelectorAll('img, video').forEach(m => m.removeAttribute('src'));
+            cell.replaceChildren();
+            pruned += 1;
+        });
+        return pruned;
+    """ % SEEN_ATTRIBUTE, margin)
+
+# Bounds of the tweets entirely visible in the viewport, in CSS pixels.
+# A tweet is left out if anything covers its top or bottom edge, e.g. the sticky header,
+# or if its images are still loading.
+VISIBLE_TWEETS_SCRIPT = """
+    const unobscured = (tweet, x, y) => {
+        const element = document.elementFromPoint(x, y);
+        return element !== null && tweet.contains(element);
+    };
+    const tweets = [];
+    document.querySelectorAll('[data-testid="tweet"]').forEach(tweet => {
+        const r = tweet.getBoundingClientRect();
+        if (r.height <= 0 || r.top < 0 || r.left < 0 || r.bottom > window.innerHeight || r.right > window.innerWidth)
+            return;
+
+        const x = (r.left + r.right) / 2;
+        if (!unobscured(tweet, x, r.top + 1) || !unobscured(tweet, x, r.bottom - 1))
+            return;
+        if (!Array.from(tweet.querySelectorAll('img')).every(img => img.complete))
+            return;
+
+        tweets.push({element: tweet, left: r.left, top: r.top, right: r.right, bottom: r.bottom});
+    });
+    return {ratio: window.devicePixelRatio || 1, tweets: tweets};
+"""
+
+class ViewportCapture:
+    """
+    Crops tweet screenshots out of one screenshot of the viewport, instead of capturing each tweet.
+    The viewport is captured again once a tweet was not entirely visible in the last capture.
+    """
+    def __init__(self):
+        self.png = None
+        # Pixel boxes of the last capture, by WebElement id.
+        self.boxes: Dict[str, Tuple[int, int, int, int]] = {}
+
+        self.captures = 0
+        self.crops = 0
+        self.misses = 0
+
+    def capture(self, driver: webdriver):
+        # Bounds first, nothing runs in the page between both calls.
+        visible = driver.execute_script(VISIBLE_TWEETS_SCRIPT)
+        self.png = driver.get_screenshot_as_png()
+        self.captures += 1
+
+        ratio = visible["ratio"]
+        self.boxes = {
+            t["element"].id: tuple(int(round(t[k] * ratio)) for k in ("left", "top", "right", "bottom"))
+            for t in visible["tweets"]
+        }
+
+    def crop(self, driver: webdriver, element) -> Union[Tuple[bytes, Tuple[int, int, int, int]], None]:
+        """Returns a capture holding element and its box in it, or None if it does not fit the viewport."""
+        box = self.boxes.get(element.id)
+        if box is None:
+            self.capture(driver)
+            box = self.boxes.get(element.id)
+
+        if box is None:
+            self.misses += 1
+            return None
+
+        self.crops += 1
+        return self.png, box
+
 class TweetExtractor:
     """
     Generates Tweets from a page of tweets.
     Since tweets can occur in several types of pages, this is considered a helper.
     """
 
-    def __init__(self, root_dir: str, max_captures: int = None):
+    def __init__(self, root_dir: str, max_captures: int = None, focal_id: str = None, settings: CrawlSettings = None, depth: int = 0):
         self.counter = 0
         self.last_id = 0
         self.last_id_count = 0
@@ -129,6 +369,37 @@ class TweetExtractor:
         self.root_dir = root_dir
         self.max_captures = max_captures
 
+        # Id of the main tweet when extracting from a thread page.
+        self.focal_id = focal_id
+        self.past_focal = False
+
+        # Tweets resolved from the timeline vs. by opening a new tab.
+        self.resolved_count = 0
+        self.fallback_count = 0
+
+        # WebDriver calls made while capturing, used for debugging throughput.
+        self.round_trips = 0
+        self.settings = settings or CrawlSettings()
+        self.pruned_count = 0
+        # Depth of the page, thread jobs spawned from it are one deeper.
+        self.depth = depth
+        # Tweets are written as they are captured, so a crash only loses the current one.
+        self.stream = TweetStream(root_dir)
+
+        self.viewport = None
+        if self.settings.capture_mode == "viewport":
+            if pillow_available():
+                self.viewport = ViewportCapture()
+            else:
+                logger.warning("Pillow is not installed, capturing each tweet instead of cropping the viewport.")
+
+        # Tweets archived by previous runs, skipped in incremental mode.
+        self.known = {}
+        if self.settings.incremental:
+            self.known = {t["id"]: t for t in load_known_tweets(root_dir)}
+        self.known_count = 0
+        self.known_run = 0
+
     def get_scroll_offset_history(self) -> List[float]:
         """
         Returns a list of offset scrolls done by capture_all_available_tweets()
@@ -137,98 +408,145 @@ class TweetExtractor:
         return self.height_diffs
 
     def write_json(self):
-        with open(os.path.join(self.root_dir, "tweets.json"), "w", encoding="utf-8") as f:
-            json.dump(self.get_tweets_as_dict(), f, ensure_ascii=False)
+        """
+        Closes the stream of tweets and compacts it into tweets.json.
+        In incremental mode, tweets of this run go first, followed by those archived before.
+        """
+        self.stream.close()
+        if self.settings.incremental:
+            compact_tweet_stream(self.root_dir, since=self.stream.start, previous=list(self.known.values()))
+        else:
+            compact_tweet_stream(self.root_dir)
+
+    def skip_known(self, tweet_id: str) -> bool:
+        """
+        Returns True if tweet_id is archived already.
+        Raises KnownTweetsReached once settings.known_stop archived tweets were seen in a row.
+        """
+        if tweet_id not in self.known:
+            self.known_run = 0
+            return False
+
+        self.known_count += 1
+        self.known_run += 1
+        if self.settings.known_stop and self.known_run >= self.settings.known_stop:
+            logger.debug("Seen {} archived tweets in a row, stopping.".format(self.known_run))
+            raise KnownTweetsReached()
+        return True
+
+    def get_tweet(self, tweet_dom: TweetDom, driver: webdriver, fetch_threads: int, load_time: int, offset_func: Callable) -> Tweet:
+        # When we move to a new page, this is the target data we want to obtain
+        current_tweet_data = tweet_dom.tweet
+
+        # Fast path, the timestamp anchor on the timeline already holds the id.
+        permalink = tweet_dom.permalink
+        if permalink is None:
+            self.fallback_count += 1
+            logger.debug("No status link found, resolving through a new tab.")
+            tm = self.get_tweet_from_new_tab(current_tweet_data, tweet_dom.element, driver, fetch_threads, load_time, offset_func)
+            if tm is not None and self.skip_known(tm.id):
+                return None
+            return tm
+
+        if permalink.id == self.focal_id:
+            # The main tweet of a thread page is already archived by the thread itself.
+            self.past_focal = True
+            return None
+
+        # Archived tweets keep their screenshot and thread.
+        if self.skip_known(permalink.id):
+            return None
+
+        # Keep the timeline data intact for the thread job.
+        tm = Tweet(**asdict(current_tweet_data))
+        tm.id = permalink.id
+        if tm.handle == "ERR":
+            tm.handle = permalink.handle
+
+        # A reply joined to the tweet above it, e.g. in a self-reply chain, answers that tweet.
+        # Otherwise anything below the main tweet of a thread page is a response to it.
+        if tweet_dom.connected and tweet_dom.parent is not None:
+            tm.parent_id = tweet_dom.parent.id
+        elif self.focal_id is not None and self.past_focal:
+            tm.parent_id = self.focal_id
+
+        self.resolved_count += 1
+        self.track_boost(tm)
+
+        # Create a folder to house pictures, etc.
+        tweet_folder_fpath = os.path.join(self.root_dir, tm.id)
+        os.makedirs(tweet_folder_fpath, exist_ok=True)
+        if VISITED.claim_screenshot(tweet_folder_fpath, tm.id):
+            self.screenshot_tweet(driver, tweet_dom.element, os.path.join(tweet_folder_fpath, "{}.png".format(tm.id)))
+        else:
+            logger.debug("Tweet {} already captured, skipping screenshot.".format(tm.id))
 
-    def get_tweet(self, tweet_dom, driver: webdriver, fetch_threads: int, load_time: int, offset_func: Callable) -> Tweet:
+        self.queue_thread_job(current_tweet_data, permalink.url, driver, fetch_threads, load_time, offset_func, open_tab=True, metadata=tm)
+        return tm
+
+    def screenshot_tweet(self, driver: webdriver, element, fpath: str):
+        """Crops the tweet out of a capture of the viewport if possible, captures the tweet itself otherwise."""
+        if self.viewport is not None:
+            capture = self.viewport.crop(driver, element)
+            if capture is not None:
+                save_screenshot(fpath, *capture)
+                return
+        save_screenshot(fpath, element.screenshot_as_png)
+
+    def get_tweet_from_new_tab(
+        self,
+        current_tweet_data: Tweet,
+        tweet_dom,
+        driver: webdriver,
+        fetch_threads: int,
+        load_time: int,
+        offset_func: Callable) -> Tweet:
+        """
+        Determines the id of the tweet by looking at it in a separate window.
+        Only used when the timeline does not expose a status link.
+        """
         # Lazy load because of circular dependencies.
         # this can be avoided if we pull out the logic at some point.
         from tb_watcher.pages import TwitterThread
 
-        # Determine the id of the tweet by look at it in a separate window
         windows_before  = driver.current_window_handle
-        window_count = len(driver.window_handles)
         new_window = None
+        # Tab slots share their browser's windows, others may open or close tabs meanwhile.
+        browser = getattr(driver, "tbw_tab_browser", None)
+        lock = browser.lock if browser is not None else contextlib.nullcontext()
 
-        # When we move to a new page, this is the target data we want to obtain
-        current_tweet_data = tweet_dom_get_basic_metadata(tweet_dom)
         try:
-            try:
-                action = webdriver.common.action_chains.ActionChains(driver)
-                action.move_to_element_with_offset(tweet_dom, tweet_dom.size["width"] // 2, 5) \
-                    .key_down(Keys.CONTROL) \
-                    .click() \
-                    .key_up(Keys.CONTROL) \
-                    .perform()
-            except selenium.common.exceptions.ElementClickInterceptedException:
-                # It is okay for clicks to be intercepted.
-                pass
-
-            if len(driver.window_handles) == window_count:
-                logger.debug("Attempted to click main thread on: {}".format(tweet_dom))
-                # Selecting the main thread which is not clickable.
-                return None
-
-            new_window = driver.window_handles[-1]
-            driver.switch_to.window(new_window)
+            with lock:
+                handles = set(driver.window_handles)
+                try:
+                    action = webdriver.common.action_chains.ActionChains(driver)
+                    action.move_to_element_with_offset(tweet_dom, tweet_dom.size["width"] // 2, 5) \
+                        .key_down(Keys.CONTROL) \
+                        .click() \
+                        .key_up(Keys.CONTROL) \
+                        .perform()
+                except selenium.common.exceptions.ElementClickInterceptedException:
+                    # It is okay for clicks to be intercepted.
+                    pass
+
+                opened = [h for h in driver.window_handles if h not in handles]
+                if not opened:
+                    logger.debug("Attempted to click main thread on: {}".format(tweet_dom))
+                    # Selecting the main thread which is not clickable.
+                    return None
+
+                new_window = opened[-1]
+                driver.switch_to.window(new_window)
+            BUDGET.charge_page()
 
             # Clicking on a tweet guarantees it to be a TwitterThread page.
-            tt = TwitterThread(current_tweet_data, self.prev_tweet, self.root_dir, driver.current_url, fetch_threads=fetch_threads, existing_driver=driver)
+            tt = TwitterThread(current_tweet_data, self.prev_tweet, self.root_dir, driver.current_url,
+                               fetch_threads=fetch_threads, existing_driver=driver, settings=self.settings)
             tm = tt.fetch_metadata()
-            if tm.tweet_text != "NULL":
-                if tm.tweet_text in self.boosted_tracker:
-                    # We need to go back in time to find the boosted post!
-                    # We match boosts by tweet text.
-                    for t in self.tweets_tracker:
-                        if t.tweet_text == tm.tweet_text:
-                            t.potential_boost = True
-                            break
-
-                tm.potential_boost = False
-                self.boosted_tracker.add(tm.tweet_text)
-            else:
-                tm.potential_boost = False
-
-            self.prev_tweet = tm
-            if fetch_threads > 0:
-                logger.debug("Thread depth {}".format(fetch_threads))
-                # Spawn a new thread and leave it.
-                current_url = str(driver.current_url)
-                def _new_thread(is_new_thread: bool):
-                    if is_new_thread:
-                        new_driver = create_chrome_driver()
-                        new_driver.get(current_url)
-                        # Wait for driver oload new page
-                        state = ""
-                        while state != "complete":
-                            time.sleep(random.uniform(3, 5))
-                            state = new_driver.execute_script("return document.readyState")
-
-                        WebDriverWait(new_driver, 30).until(EC.presence_of_element_located(
-                            (By.CSS_SELECTOR, '[data-testid="tweet"]')))
-                    else:
-                        new_driver = driver
-
-                    try:
-                        tt = TwitterThread(
-                            current_tweet_data,
-                            self.prev_tweet,
-                            self.root_dir,
-                            current_url,
-                            fetch_threads=fetch_threads,
-                            existing_driver=new_driver)
-                        tt.fetch_tweets(
-                            self.max_captures,
-                            load_time,
-                            offset_func
-                        )
-                    finally:
-                        if is_new_thread:
-                            new_driver.close()
-                add_job(_new_thread)
-            else:
-                logger.debug("Thread depth reached.")
+            self.track_boost(tm)
 
+            # The new tab is already on the thread page, so inline jobs can reuse it.
+            self.queue_thread_job(current_tweet_data, str(driver.current_url), driver, fetch_threads, load_time, offset_func, open_tab=False, metadata=tm)
         finally:
             # Close all non-windows
             if new_window is not None:
@@ -238,11 +556,70 @@ class TweetExtractor:
 
         return tm
 
+    def track_boost(self, tm: Tweet):
+        """Marks potential self-boosts by matching tweet texts and chains the tweet as the previous one."""
+        if tm.tweet_text != "NULL":
+            if tm.tweet_text in self.boosted_tracker:
+                # We need to go back in time to find the boosted post!
+                # We match boosts by tweet text.
+                for t in self.tweets_tracker:
+                    if t.tweet_text == tm.tweet_text:
+                        t.potential_boost = True
+                        self.stream.update(t)
+                        break
+
+            tm.potential_boost = False
+            self.boosted_tracker.add(tm.tweet_text)
+        else:
+            tm.potential_boost = False
+
+        self.prev_tweet = tm
+
+    def queue_thread_job(
+        self,
+        current_tweet_data: Tweet,
+        current_url: str,
+        driver: webdriver,
+        fetch_threads: int,
+        load_time: int,
+        offset_func: Callable,
+        open_tab: bool,
+        metadata: Tweet):
+        """
+        Queues archiving the thread of a tweet if depth allows it.
+        When run inline, open_tab loads the thread in a new tab of driver instead of its current window.
+        metadata is the resolved tweet, handed to the job so it does not fetch it again.
+        """
+        # Lazy load because of circular dependencies.
+        from tb_watcher.jobs import ThreadJob, submit_thread_job
+
+        if fetch_threads <= 0:
+            logger.debug("Thread depth reached.")
+            return
+
+        if metadata is not None and not VISITED.claim_thread(metadata.id):
+            logger.debug("Thread {} already visited, skipping.".format(metadata.id))
+            return
+
+        logger.debug("Thread depth {}".format(fetch_threads))
+        job = ThreadJob(
+            current_url,
+            self.root_dir,
+            fetch_threads,
+            self.max_captures,
+            load_time,
+            current_tweet_data,
+            self.prev_tweet,
+            self.settings,
+            metadata,
+            self.depth + 1)
+        submit_thread_job(job, driver, offset_func, open_tab)
+
     def update_recommended_tweets_height(self, driver: webdriver, force: bool=False):
         """Only update if we have seen recommended tweets."""
         # We should update if more replies were generated.
         if force or self.recommended_tweets_height is None:
-            h = get_recommend_tweets_height(driver)
+            h = page_observer_state(driver)["recommended_height"]
             if h is not None:
                 self.recommended_tweets_height = h
 
@@ -263,20 +640,29 @@ class TweetExtractor:
         if self.max_captures and self.counter >= self.max_captures:
             raise MaxCapturesReached()
 
+        counter = command_counter(driver)
+        calls_before = counter.count
+
+        # Ads, popups and the recommended section are tracked in page from here on.
+        observer = page_observer_state(driver)
+        logger.debug("Page observer removed {} ads and {} popups so far.".format(
+            observer["ads_removed"], observer["elements_removed"]))
+
         force_update = hit_more_replies(driver)
         self.update_recommended_tweets_height(driver, force_update)
         # Makesure we haven't hit recommended tweets section
         exit_loop = False
         while not exit_loop:
-            tweets = driver.find_elements(By.CSS_SELECTOR, '[data-testid="tweet"]')
+            # Only tweets which have not been processed by a previous call.
+            tweets = bulk_tweet_dom_get_metadata(driver, unseen_only=True)
+            if len(tweets) == 0:
+                break
+
+            # Duplicates are tagged in bulk as they skip the scroll which tags them.
+            skipped = []
             for tweet in tweets:
+                tweet_calls_before = counter.count
                 try:
-                    ad = remove_ads(driver)
-                    remove_elements(driver, ["sheetDialog", "confirmationSheetDialog", "mask"])
-                    if ad:
-                        logger.debug("AD SKIP {}".format(ad))
-                        continue
-
                     force_update = hit_more_replies(driver)
                     self.update_recommended_tweets_height(driver, force_update)
                     # Force update if we hit reply to get latest values.
@@ -287,16 +673,28 @@ class TweetExtractor:
                     # To save potential duplicates, we check
                     # first a unique id via tags to see if
                     # we can skip prior to heavy post-processing.
-                    div_id = tweet.get_attribute("aria-labelledby")
+                    div_id = tweet.div_id
                     if div_id in self.div_track:
                         logger.debug("DIV SKIP {}".format(div_id))
+                        skipped.append(tweet.element)
                         continue
 
                     self.div_track.add(div_id)
-                    driver.execute_script("return arguments[0].scrollIntoView();", tweet)
-                    driver.execute_script("window.scrollTo(0, window.pageYOffset - 50);")
+                    height = driver.execute_script("""
+                        // Ads are emptied by the page observer, which detaches their tweet.
+                        if (!arguments[0].isConnected)
+                            return null;
+
+                        arguments[0].setAttribute('{}', '1');
+                        arguments[0].scrollIntoView();
+                        window.scrollTo(0, window.pageYOffset - 50);
+                        return window.scrollTop || window.pageYOffset;
+                    """.format(SEEN_ATTRIBUTE), tweet.element)
+                    if height is None:
+                        logger.debug("AD SKIP {}".format(div_id))
+                        continue
 
-                    height = float(driver.execute_script("return window.scrollTop || window.pageYOffset;"))
+                    height = float(height)
                     logger.debug("HEIGHT: {}".format(height))
                     logger.debug("RECOMMEND HEIGHT: {}".format(self.recommended_tweets_height))
                     # Verify that we are not in the recommended tweets section, if so, fail.
@@ -312,6 +710,8 @@ class TweetExtractor:
 
                 # Tweet info
                 full_dtm = self.get_tweet(tweet, driver, fetch_threads, load_time, offset_func)
+                logger.debug("Tweet {} took {} WebDriver round-trips.".format(
+                    full_dtm.id if full_dtm else None, counter.count - tweet_calls_before))
                 # We've seen this post before or is invalid tweet.
                 if full_dtm is None or full_dtm in self.tweets_tracker:
                     continue
@@ -320,11 +720,19 @@ class TweetExtractor:
                 self.counter += 1
                 self.tweets_tracker.add(full_dtm)
                 self.tweets_ordered.append(full_dtm)
+                self.stream.write(full_dtm)
 
                 if self.max_captures and self.counter > self.max_captures:
                     exit_loop = True
                     break
 
+            mark_tweet_doms_seen(driver, skipped)
+
+        if self.settings.prune_dom:
+            self.pruned_count += prune_seen_tweet_doms(driver)
+
+        self.round_trips += counter.count - calls_before
+
     def get_tweets_as_dict(self) -> List[dict]:
         results = []
         for t in self.tweets_ordered:
@@ -334,17 +742,35 @@ class TweetExtractor:
     def create_offset_function(self, offset_func: Callable):
         return lambda: offset_func(self.height_diffs)
 
+# Optionally scrolls, then returns what tells if new content was loaded.
+SCROLL_PROBE_SCRIPT = """
+    if (arguments[0] !== null)
+        window.scrollTo(0, arguments[0]);
+
+    return {
+        height: document.body.scrollHeight,
+        unseen: document.querySelectorAll('[data-testid="tweet"]:not([%s])').length,
+        resources: %s
+    };
+""" % (SEEN_ATTRIBUTE, RESOURCE_COUNT_EXPRESSION)
+
 class Scroller:
     """
     Encapsulates a scrolling mechanism to generate more Tweets on a given page.
     Requires a data previous scrolls to do predictions.
+
+    By default waits load_time to load_time + 2 seconds after each scroll.
+    If adaptive, returns as soon as new tweets or height show up and no resource
+    has loaded for settle seconds, with load_time + 2 seconds as the ceiling.
     """
-    def __init__(self, driver: webdriver, offset_func: Callable, load_time: int):
+    def __init__(self, driver: webdriver, offset_func: Callable, load_time: int, adaptive: bool = False, settle: float = 0.5):
         self.prev_height = 0
         self.offset_func = offset_func
         self.driver = driver
         self.load_time = load_time
         self.height = 0
+        self.adaptive = adaptive
+        self.settle = settle
 
     def __iter__(self):
         self.prev_height = 0
@@ -353,6 +779,10 @@ class Scroller:
 
     def __next__(self):
         predict_next_scroll = self.offset_func() + self.prev_height
+        if self.adaptive:
+            self.prev_height = self.wait_for_content(predict_next_scroll)
+            return
+
         self.driver.execute_script("window.scrollTo(0, {});".format(predict_next_scroll))
 
         # Wait for data to load.
@@ -365,42 +795,131 @@ class Scroller:
 
         self.prev_height = new_height
 
+    def wait_for_content(self, scroll_to: float) -> float:
+        """Scrolls and waits for new content, returns the new height or raises StopIteration at the end of the page."""
+        start = time.perf_counter()
+        probe = self.driver.execute_script(SCROLL_PROBE_SCRIPT, scroll_to)
+        unseen_before = probe["unseen"]
+        # Content which grew while tweets were captured says nothing about scroll latency.
+        grew_before_scroll = probe["height"] != self.prev_height
+
+        # No need to look before content usually shows up.
+        typical = SCROLL_LATENCY.typical()
+        interval = max(POLL_INTERVAL, 0.8 * typical) if typical else POLL_INTERVAL
+
+        grown_at = None
+        last_resources = probe["resources"]
+        quiet_since = start
+        while True:
+            time.sleep(interval)
+            probe = self.driver.execute_script(SCROLL_PROBE_SCRIPT, None)
+            now = time.perf_counter()
+
+            if grown_at is None and (probe["height"] != self.prev_height or probe["unseen"] > unseen_before):
+                grown_at = now
+                if not grew_before_scroll:
+                    SCROLL_LATENCY.add(now - start)
+
+            if probe["resources"] != last_resources:
+                last_resources = probe["resources"]
+                quiet_since = now
+
+            if grown_at is not None and now - quiet_since >= self.settle:
+                break
+
+            if now - start >= self.load_time + 2:
+                if grown_at is None:
+                    # We've  hit the end of the page
+                    raise StopIteration
+                break
+
+            # Back off while nothing changes, poll quickly while media settles.
+            interval = min(interval * 1.5, 1.0) if grown_at is None else POLL_INTERVAL
+
+        logger.debug("Scroll loaded in {:.2f}s.".format(time.perf_counter() - start))
+        return probe["height"]
+
+# Installed once per document, removes ads and popups as they are rendered
+# and keeps track of the recommended tweets section.
+# Returns the observer state, installing the observer first if needed.
+PAGE_OBSERVER_SCRIPT = """
+    if (!window.tbwObserver) {
+        const state = {adsRemoved: 0, elementsRemoved: 0, recommended: null};
+        const popups = arguments[0].map(v => `[data-testid='${v}']`).join(',');
+
+        // Text matches are made on the outermost element holding only that text.
+        const outermost = (node, text) => {
+            let element = node.parentElement;
+            while (element.parentElement && element.parentElement.textContent == text)
+                element = element.parentElement;
+            return element;
+        };
+        const checkText = (node) => {
+            if (node.nodeValue == 'Promoted Tweet') {
+                const p = outermost(node, 'Promoted Tweet').parentNode.parentNode.parentNode;
+                if (p) {
+                    p.innerHTML = "";
+                    state.adsRemoved += 1;
+                }
+            } else if (node.nodeValue == 'More Tweets' && !(state.recommended && state.recommended.isConnected)) {
+                state.recommended = outermost(node, 'More Tweets');
+            }
+        };
+        const scan = (root) => {
+            if (root.nodeType == Node.TEXT_NODE) {
+                if (root.parentElement)
+                    checkText(root);
+                return;
+            }
+            if (root.nodeType != Node.ELEMENT_NODE)
+                return;
+
+            // Some weird elements are better removing parent to
+            // remove render artifacts.
+            const found = root.matches(popups) ? [root] : Array.from(root.querySelectorAll(popups));
+            found.forEach(element => {
+                const parent = element.parentNode;
+                if (parent && parent.parentNode) {
+                    parent.parentNode.removeChild(parent);
+                    state.elementsRemoved += 1;
+                }
+            });
+
+            const walker = document.createTreeWalker(root, NodeFilter.SHOW_TEXT);
+            for (let node = walker.nextNode(); node; node = walker.nextNode())
+                checkText(node);
+        };
+
+        scan(document.body);
+        new MutationObserver(records => {
+            for (const record of records) {
+                if (record.type == 'characterData') {
+                    scan(record.target);
+                } else {
+                    record.addedNodes.forEach(scan);
+                }
+            }
+        }).observe(document.body, {childList: true, subtree: true, characterData: true});
+        window.tbwObserver = state;
+    }
+
+    const state = window.tbwObserver;
+    const recommended = state.recommended && state.recommended.isConnected ? state.recommended : null;
+    return {
+        ads_removed: state.adsRemoved,
+        elements_removed: state.elementsRemoved,
+        recommended_height: recommended ? recommended.getBoundingClientRect().top + window.scrollY : null
+    };
+"""
 
-def remove_elements(driver: webdriver , elements: List[str], remove_parent: bool = True):
-    elements = ["'{}'".format(v) for v in elements]
-    if remove_parent:
-        # Some weird elements are better removing parent to
-        # remove render artifacts.
-        driver.execute_script("""
-        const values = [{}];
-        for (let i = 0; i < values.length; ++i) {{
-            var element = document.querySelector(`[data-testid='${{values[i]}}']`);
-            if (element)
-                element.parentNode.parentNode.removeChild(element.parentNode);
-        }}
-        """.format(",".join(elements)))
-
-    driver.execute_script("""
-    const values = [{}];
-    for (let i = 0; i < values.length; ++i) {{
-        var element = document.querySelector(`[data-testid='${{values[i]}}']`);
-        if (element)
-            element.parentNode.removeChild(element);
-    }}
-    """.format(",".join(elements)))
-
-def remove_ads(driver: webdriver) -> bool:
-    return driver.execute_script("""
-        var elems = document.querySelectorAll("*"),
-            res = Array.from(elems).find(v => v.textContent == 'Promoted Tweet');
+OBSERVED_POPUPS = ["sheetDialog", "confirmationSheetDialog", "mask", "BottomBar"]
 
-        if (res) {
-            let p = res.parentNode.parentNode.parentNode;
-            p.innerHTML="";
-            return true;
-        }
-        return false;
-    """)
+def page_observer_state(driver: webdriver) -> dict:
+    """
+    Returns the state of the page observer in one call, installing it on new documents.
+    Keys are ads_removed, elements_removed and recommended_height (None if not seen yet).
+    """
+    return driver.execute_script(PAGE_OBSERVER_SCRIPT, OBSERVED_POPUPS)
 
 def hit_more_replies(driver: webdriver):
     """Hits both thread wide and per-thread responses."""
@@ -421,21 +940,53 @@ def hit_more_replies(driver: webdriver):
 
     return return_result
 
-def get_recommend_tweets_height(driver: webdriver):
-    return driver.execute_script("""
-        var elems = document.querySelectorAll("*"),
-            res = Array.from(elems).find(v => v.textContent == 'More Tweets');
-
-        if (res) {
-            return res.getBoundingClientRect().top + window.scrollY;
-        }
-        return null;
-    """)
-
-def create_chrome_driver() -> webdriver:
-    """Creates a chrome driver with silenced warnings and custom options."""
+def create_chrome_driver(arguments: List[str] = None) -> webdriver:
+    """
+    Creates a chrome driver with silenced warnings and custom options, plus any extra command line arguments.
+    The resource policy, see resources.set_resource_policy(), applies to it.
+    """
+    policy = get_resource_policy()
     options = webdriver.ChromeOptions()
     options.add_experimental_option('excludeSwitches', ['enable-logging'])
-    driver = webdriver.Chrome(options=options, service=Service(ChromeDriverManager().install()))
+    for argument in (arguments or []) + policy.chrome_arguments:
+        options.add_argument(argument)
+    if policy.block_images:
+        options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    # Requests made and blocked are read from it, see record_page_resources().
+    if policy.stats:
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+
+    driver = webdriver.Chrome(options=options, service=Service(resolve_chromedriver_path()))
     driver.set_window_size(*DEF_WINDOW_SIZE)
+    apply_resource_policy(driver)
     return driver
+
+def apply_resource_policy(driver: webdriver):
+    """Blocks the URLs of the resource policy in the current tab of driver. New tabs need it applied again."""
+    policy = get_resource_policy()
+    if policy.blocked_urls:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": policy.blocked_urls})
+
+def drain_resource_log(driver: webdriver):
+    """Discards the requests logged so far, e.g. by the page driver was on before."""
+    if not get_resource_policy().stats:
+        return
+    try:
+        driver.get_log("performance")
+    except Exception as e:
+        logger.debug("Unable to read the performance log: {}".format(e))
+
+def record_page_resources(driver: webdriver, page_type: str):
+    """
+    Counts the requests made and blocked since the last call as those of a page of page_type.
+    The log is shared by the tabs of a browser, so with tabs a page may be charged for its neighbours.
+    """
+    if not get_resource_policy().stats:
+        return
+    try:
+        entries = driver.get_log("performance")
+    except Exception as e:
+        logger.debug("Unable to read the performance log: {}".format(e))
+        return
+    record_resources(page_type, count_log_entries(entries))
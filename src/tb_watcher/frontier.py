@@ -0,0 +1,250 @@
+"""
+Persistent crawl frontier, so an interrupted crawl resumes where it stopped.
+Jobs live in a SQLite database which several local processes can share, each job being claimed by one of them.
+
+By: ProgrammingIncluded
+"""
+# std
+import os
+import time
+import pickle
+import socket
+import sqlite3
+import threading
+
+from dataclasses import dataclass
+from typing import Dict, List, Set, Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.jobs import ProfileJob, ThreadJob
+from tb_watcher.sharding import pid_alive
+
+# Seconds a claimed job stays owned without its lease being renewed.
+DEF_LEASE_SECONDS = 300.0
+# Attempts before a failing job is given up.
+DEF_MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# Only set by earlier versions, jobs left out by a budget stay pending.
+DROPPED = "dropped"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE NOT NULL,
+        kind TEXT NOT NULL,
+        url TEXT NOT NULL,
+        depth INTEGER NOT NULL,
+        profile INTEGER NOT NULL,
+        profile_url TEXT,
+        parent_id TEXT,
+        payload BLOB NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        owner TEXT,
+        lease_until REAL,
+        started_at REAL,
+        finished_at REAL,
+        tweets INTEGER,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, depth, profile, id);
+"""
+
+# Indexes on columns added since the first release go after migrate().
+INDEX_SCHEMA = """
+    CREATE INDEX IF NOT EXISTS jobs_profile_url ON jobs (profile_url);
+"""
+
+@dataclass(init=True, repr=True)
+class FrontierJob:
+    """A job claimed from the frontier."""
+    id: int
+    kind: str
+    depth: int
+    # Order of the profile in the crawl which added the job, and its url.
+    profile: int
+    profile_url: str
+    attempts: int
+    job: Union[ProfileJob, ThreadJob]
+
+class Frontier:
+    """
+    Queue of profile and thread jobs stored in SQLite.
+    Jobs are claimed shallowest first with a lease, renewed while the claiming process is alive.
+    A job whose lease expired, or whose owner on this host died, is claimed again until it ran out of attempts.
+    """
+    def __init__(self, fpath: str, lease_seconds: float = DEF_LEASE_SECONDS, max_attempts: int = DEF_MAX_ATTEMPTS):
+        self.fpath = fpath
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+
+        # Connections can not be shared between threads.
+        self.local = threading.local()
+        self.heartbeat = None
+        self.stopped = threading.Event()
+
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        self.migrate(conn)
+        conn.executescript(INDEX_SCHEMA)
+
+    def migrate(self, conn: sqlite3.Connection):
+        """Adds profile_url to frontiers made before it, guessing it from the profile order they were made with."""
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if "profile_url" in columns:
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("ALTER TABLE jobs ADD COLUMN profile_url TEXT")
+        conn.execute(
+            "UPDATE jobs SET profile_url = (SELECT p.url FROM jobs p WHERE p.kind = 'profile' AND p.profile = jobs.profile "
+            "ORDER BY p.id LIMIT 1)")
+        conn.execute("COMMIT")
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Autocommit, transactions are opened explicitly.
+            conn = sqlite3.connect(self.fpath, timeout=30.0, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def add(
+        self,
+        key: str,
+        job: Union[ProfileJob, ThreadJob],
+        depth: int,
+        profile: int,
+        profile_url: str,
+        parent_id: str = None
+    ) -> bool:
+        """Adds a job unless one with key exists. Returns True if added."""
+        kind = "profile" if isinstance(job, ProfileJob) else "thread"
+        cur = self.connect().execute(
+            "INSERT OR IGNORE INTO jobs (key, kind, url, depth, profile, profile_url, parent_id, payload) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, kind, job.url, depth, profile, profile_url, parent_id, pickle.dumps(job)))
+        return cur.rowcount > 0
+
+    def claim(self, skip: Set[int] = None) -> Union[FrontierJob, None]:
+        """
+        Claims the shallowest pending job, or one whose lease expired, leaving out the ids in skip.
+        Returns None if there is none.
+        """
+        conn = self.connect()
+        now = time.time()
+        skip = sorted(skip or [])
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Jobs which keep wedging their worker are not retried forever.
+            conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, lease_until = NULL, finished_at = ?, error = ? "
+                "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, now, "lease expired", RUNNING, now, self.max_attempts))
+            row = conn.execute(
+                "SELECT id, kind, depth, profile, profile_url, attempts, payload FROM jobs "
+                "WHERE (status = ? OR (status = ? AND lease_until < ?)) AND id NOT IN ({}) "
+                "ORDER BY depth, profile, id LIMIT 1".format(", ".join("?" * len(skip))),
+                [PENDING, RUNNING, now] + skip).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1, "
+                "started_at = COALESCE(started_at, ?) WHERE id = ?",
+                (RUNNING, self.owner, now + self.lease_seconds, now, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        job_id, kind, depth, profile, profile_url, attempts, payload = row
+        return FrontierJob(job_id, kind, depth, profile, profile_url, attempts + 1, pickle.loads(payload))
+
+    def complete(self, claimed: FrontierJob, tweets: int = None, error: str = None):
+        """Marks a claimed job done, or failed once it ran out of attempts. Failing jobs are otherwise retried."""
+        if error is None:
+            status = DONE
+        elif claimed.attempts >= self.max_attempts:
+            status = FAILED
+        else:
+            status = PENDING
+
+        self.connect().execute(
+            "UPDATE jobs SET status = ?, owner = NULL, lease_until = NULL, finished_at = ?, tweets = ?, error = ? WHERE id = ?",
+            (status, time.time(), tweets, error, claimed.id))
+
+    def release(self, claimed: FrontierJob):
+        """
+        Puts back a claimed job without running it, e.g. once the crawl budget ran out,
+        so this or a later crawl runs it. The claim does not count as an attempt.
+        """
+        self.connect().execute(
+            "UPDATE jobs SET status = ?, owner = NULL, lease_until = NULL, attempts = attempts - 1 WHERE id = ? AND owner = ?",
+            (PENDING, claimed.id, self.owner))
+
+    def recover(self) -> int:
+        """Releases the jobs left running by dead processes of this host. Returns how many."""
+        host = socket.gethostname()
+        released = 0
+        conn = self.connect()
+        for job_id, owner in conn.execute("SELECT id, owner FROM jobs WHERE status = ?", (RUNNING,)).fetchall():
+            owner_host, _, pid = (owner or "").rpartition(":")
+            if owner_host != host or not pid.isdigit() or pid_alive(int(pid)):
+                continue
+
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, lease_until = NULL WHERE id = ? AND owner = ?",
+                (PENDING, job_id, owner))
+            released += cur.rowcount
+        return released
+
+    def renew(self):
+        """Extends the leases of every job this process is running."""
+        self.connect().execute(
+            "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = ?",
+            (time.time() + self.lease_seconds, self.owner, RUNNING))
+
+    def start_heartbeat(self):
+        """Renews this process' leases in the background until stop_heartbeat()."""
+        def _beat():
+            while not self.stopped.wait(self.lease_seconds / 3):
+                try:
+                    self.renew()
+                except sqlite3.Error as e:
+                    logger.warning("Unable to renew frontier leases: {}".format(e))
+
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(target=_beat, name="tbw-frontier-heartbeat", daemon=True)
+        self.heartbeat.start()
+
+    def stop_heartbeat(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+
+    def unfinished(self, skip: Set[int] = None) -> int:
+        """Number of jobs pending or running in any process, leaving out the ids in skip."""
+        skip = sorted(skip or [])
+        return self.connect().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?) AND id NOT IN ({})".format(", ".join("?" * len(skip))),
+            [PENDING, RUNNING] + skip).fetchone()[0]
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self.connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def profile_rows(self, profile_url: str) -> List[dict]:
+        """Returns kind, status, started_at, finished_at, tweets and error of every job of a profile."""
+        cur = self.connect().execute(
+            "SELECT kind, status, started_at, finished_at, tweets, error FROM jobs WHERE profile_url = ?", (profile_url,))
+        columns = [c[0] for c in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
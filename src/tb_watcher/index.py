@@ -0,0 +1,330 @@
+"""
+SQLite index of a snapshots folder, so archived tweets can be searched without reading every tweets.json.
+Files are indexed as the crawler writes them, index_tree() only reads the ones changed since it last ran.
+
+By: ProgrammingIncluded
+"""
+# std
+import os
+import json
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from typing import List, Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.storage import TWEETS_JSON, add_write_listener
+from tb_watcher.screenshots import SCREENSHOTS, screenshot_fpath
+from tb_watcher.pack import locate_packed
+
+METADATA_JSON = "metadata.json"
+INDEX_DB = "index.db"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL,
+        size INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS profiles (
+        username TEXT PRIMARY KEY,
+        name TEXT,
+        bio TEXT,
+        location TEXT,
+        website TEXT,
+        join_date TEXT,
+        following TEXT,
+        followers TEXT,
+        path TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS tweets (
+        id TEXT NOT NULL,
+        path TEXT NOT NULL,
+        profile TEXT NOT NULL,
+        handle TEXT,
+        name TEXT,
+        tweet_text TEXT,
+        tag_text TEXT,
+        timestamp TEXT,
+        retweet_count TEXT,
+        like_count TEXT,
+        reply_count TEXT,
+        potential_boost INTEGER,
+        parent_id TEXT,
+        screenshot TEXT,
+        datetime TEXT,
+        PRIMARY KEY (id, path)
+    );
+"""
+
+# Indexes on columns added since the first release go after migrate().
+INDEX_SCHEMA = """
+    CREATE INDEX IF NOT EXISTS tweets_handle ON tweets (handle);
+    CREATE INDEX IF NOT EXISTS tweets_parent ON tweets (parent_id);
+    CREATE INDEX IF NOT EXISTS tweets_datetime ON tweets (datetime);
+    CREATE INDEX IF NOT EXISTS tweets_path ON tweets (path);
+"""
+
+# Rows share the rowid of their tweet, contentless tables would not allow deleting them.
+FTS_SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts USING fts5 (tweet_text);
+"""
+
+TWEET_COLUMNS = [
+    "id", "path", "profile", "handle", "name", "tweet_text", "tag_text", "timestamp",
+    "retweet_count", "like_count", "reply_count", "potential_boost", "parent_id", "screenshot", "datetime"]
+
+class ArchiveIndex:
+    """
+    Tweets and bios of a snapshots folder. Paths are stored relative to the folder.
+    A tweet archived in several places, e.g. a profile and a thread, has a row per tweets.json.
+    Full text search uses FTS5 when the SQLite build has it, LIKE otherwise.
+    """
+    def __init__(self, fpath: str, root_dir: str):
+        self.fpath = fpath
+        self.root_dir = os.path.abspath(root_dir)
+        # Connections can not be shared between threads.
+        self.local = threading.local()
+
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        self.migrate(conn)
+        conn.executescript(INDEX_SCHEMA)
+        try:
+            conn.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite has no FTS5, text search falls back to LIKE.")
+            self.fts = False
+
+    def migrate(self, conn: sqlite3.Connection):
+        """Adds the datetime column to indexes made before it, their files are then read again by index_tree()."""
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(tweets)")]
+        if "datetime" in columns:
+            return
+
+        logger.info("Adding tweet times to {}, every file is read again on its next update.".format(self.fpath))
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("ALTER TABLE tweets ADD COLUMN datetime TEXT")
+        conn.execute("DROP INDEX IF EXISTS tweets_timestamp")
+        conn.execute("DELETE FROM files")
+        conn.execute("COMMIT")
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Autocommit, transactions are opened explicitly.
+            conn = sqlite3.connect(self.fpath, timeout=30.0, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def relpath(self, fpath: str) -> Union[str, None]:
+        """Returns fpath relative to the snapshots folder, None if it is outside of it."""
+        rel = os.path.relpath(os.path.abspath(fpath), self.root_dir)
+        if rel.startswith(os.pardir):
+            return None
+        return rel.replace(os.sep, "/")
+
+    def index_file(self, fpath: str) -> bool:
+        """Indexes a tweets.json or metadata.json. Returns False for any other file."""
+        rel = self.relpath(fpath)
+        if rel is None:
+            return False
+
+        fname = os.path.basename(rel)
+        if fname == TWEETS_JSON:
+            self.index_tweets(fpath, rel)
+        elif fname == METADATA_JSON:
+            self.index_metadata(fpath, rel)
+        else:
+            return False
+        return True
+
+    def index_tweets(self, fpath: str, rel: str):
+        with open(fpath, encoding="utf-8") as f:
+            tweets = json.load(f)
+
+        # <profile>/tweets.json, <profile>/<tweet id>/tweets.json and so on for deeper threads.
+        folder = os.path.dirname(rel)
+        profile = rel.split("/")[0]
+        rows = []
+        for t in tweets:
+            screenshot = self.find_screenshot("{}/{}/{}.png".format(folder, t.get("id"), t.get("id")))
+            rows.append((
+                t.get("id"), rel, profile, t.get("handle"), t.get("name"), t.get("tweet_text"), t.get("tag_text"),
+                t.get("timestamp"), t.get("retweet_count"), t.get("like_count"), t.get("reply_count"),
+                int(bool(t.get("potential_boost"))), t.get("parent_id"), screenshot, t.get("datetime")))
+
+        with self.transaction(fpath, rel) as conn:
+            self.forget(conn, rel)
+            conn.executemany(
+                "INSERT OR REPLACE INTO tweets ({}) VALUES ({})".format(
+                    ", ".join(TWEET_COLUMNS), ", ".join("?" * len(TWEET_COLUMNS))),
+                rows)
+            if self.fts:
+                conn.execute(
+                    "INSERT INTO tweets_fts (rowid, tweet_text) SELECT rowid, tweet_text FROM tweets WHERE path = ?", (rel,))
+
+    def index_metadata(self, fpath: str, rel: str):
+        with open(fpath, encoding="utf-8") as f:
+            bio = json.load(f)
+
+        with self.transaction(fpath, rel) as conn:
+            self.forget(conn, rel)
+            conn.execute(
+                "INSERT OR REPLACE INTO profiles (username, name, bio, location, website, join_date, following, followers, path) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (bio.get("username"), bio.get("name"), bio.get("bio"), bio.get("location"), bio.get("website"),
+                 bio.get("join_date"), bio.get("following"), bio.get("followers"), rel))
+
+    def find_screenshot(self, rel: str) -> Union[str, None]:
+        """Returns rel or its .webp counterpart if written, or still queued to be written, None otherwise."""
+        for candidate in (rel, screenshot_fpath(rel, "webp")):
+            fpath = os.path.join(self.root_dir, candidate)
+            if os.path.exists(fpath) or SCREENSHOTS.is_pending(fpath):
+                return candidate
+        return None
+
+    @contextmanager
+    def transaction(self, fpath: str, rel: str):
+        """Write transaction which also records the size and mtime of fpath."""
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            stat = os.stat(fpath)
+            conn.execute(
+                "INSERT OR REPLACE INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+                (rel, stat.st_mtime_ns, stat.st_size))
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def forget(self, conn: sqlite3.Connection, rel: str):
+        """Removes the rows indexed from rel."""
+        if self.fts:
+            conn.execute("DELETE FROM tweets_fts WHERE rowid IN (SELECT rowid FROM tweets WHERE path = ?)", (rel,))
+        conn.execute("DELETE FROM tweets WHERE path = ?", (rel,))
+        conn.execute("DELETE FROM profiles WHERE path = ?", (rel,))
+        conn.execute("DELETE FROM files WHERE path = ?", (rel,))
+
+    def index_tree(self) -> dict:
+        """
+        Brings the index up to date with the snapshots folder.
+        Only files whose size or mtime changed are read, rows of removed files are dropped.
+        Files moved into a pack keep their rows, packs are not read.
+        """
+        conn = self.connect()
+        indexed = dict((path, (mtime_ns, size)) for path, mtime_ns, size in conn.execute("SELECT path, mtime_ns, size FROM files"))
+        seen = set()
+        updated = 0
+        for dirpath, dirnames, fnames in os.walk(self.root_dir):
+            # Leases, reports and other bookkeeping.
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for fname in fnames:
+                if fname not in (TWEETS_JSON, METADATA_JSON):
+                    continue
+
+                fpath = os.path.join(dirpath, fname)
+                rel = self.relpath(fpath)
+                seen.add(rel)
+                stat = os.stat(fpath)
+                if indexed.get(rel) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+
+                try:
+                    self.index_file(fpath)
+                    updated += 1
+                except (OSError, ValueError) as e:
+                    logger.warning("Unable to index {}: {}".format(fpath, e))
+
+        # Packed files are still there, only in their profile's pack.
+        removed = [rel for rel in indexed if rel not in seen and locate_packed(self.root_dir, rel) is None]
+        for rel in removed:
+            conn.execute("BEGIN IMMEDIATE")
+            self.forget(conn, rel)
+            conn.execute("COMMIT")
+
+        return {"files": len(seen), "updated": updated, "removed": len(removed)}
+
+    def query(
+        self,
+        handle: str = None,
+        since: str = None,
+        until: str = None,
+        text: str = None,
+        parent_id: str = None,
+        tweet_id: str = None,
+        limit: int = 50
+    ) -> List[dict]:
+        """
+        Returns tweets matching every given filter, newest first, once per tweet id.
+        since and until compare against the ISO time of tweets, so dates such as 2023-01-31 work.
+        Tweets archived before their time was recorded never match them.
+        A text search FTS5 can not parse, e.g. bird-watch, is searched as a phrase.
+        """
+        where, params = [], []
+        if handle is not None:
+            where.append("t.handle = ?")
+            params.append(handle if handle.startswith("@") else "@" + handle)
+        if since is not None:
+            where.append("t.datetime >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("t.datetime < ?")
+            params.append(until)
+        if parent_id is not None:
+            where.append("t.parent_id = ?")
+            params.append(parent_id)
+        if tweet_id is not None:
+            where.append("t.id = ?")
+            params.append(tweet_id)
+        if text is not None and not self.fts:
+            where.append("t.tweet_text LIKE ?")
+            params.append("%{}%".format(text))
+        elif text is not None:
+            where.append("t.rowid IN (SELECT rowid FROM tweets_fts WHERE tweets_fts MATCH ?)")
+            try:
+                return self.select(where, params + [text], limit)
+            except sqlite3.OperationalError as e:
+                logger.debug("Searching {} as a phrase: {}".format(text, e))
+                return self.select(where, params + ['"{}"'.format(text.replace('"', '""'))], limit)
+        return self.select(where, params, limit)
+
+    def select(self, where: List[str], params: list, limit: int) -> List[dict]:
+        cur = self.connect().execute(
+            "SELECT {} FROM tweets t {} GROUP BY t.id ORDER BY t.datetime DESC LIMIT ?".format(
+                ", ".join("t." + c for c in TWEET_COLUMNS),
+                "WHERE " + " AND ".join(where) if where else ""),
+            params + [limit])
+        return [dict(zip(TWEET_COLUMNS, row)) for row in cur.fetchall()]
+
+    def profile(self, username: str) -> Union[dict, None]:
+        username = username if username.startswith("@") else "@" + username
+        cur = self.connect().execute("SELECT * FROM profiles WHERE username = ?", (username,))
+        row = cur.fetchone()
+        return dict(zip([c[0] for c in cur.description], row)) if row else None
+
+    def counts(self) -> dict:
+        conn = self.connect()
+        return {
+            "profiles": conn.execute("SELECT COUNT(*) FROM profiles").fetchone()[0],
+            "tweets": conn.execute("SELECT COUNT(DISTINCT id) FROM tweets").fetchone()[0],
+            "files": conn.execute("SELECT COUNT(*) FROM files").fetchone()[0],
+        }
+
+INDEX: Union[ArchiveIndex, None] = None
+
+def init_index(root_dir: str, fpath: str = None) -> ArchiveIndex:
+    """Indexes every tweets.json and metadata.json the crawler writes under root_dir from now on."""
+    global INDEX
+    if INDEX is not None:
+        return INDEX
+
+    INDEX = ArchiveIndex(fpath or os.path.join(root_dir, INDEX_DB), root_dir)
+    add_write_listener(INDEX.index_file)
+    return INDEX
@@ -0,0 +1,108 @@
+"""
+Crawl jobs which can be serialized, so they can be sent to worker processes.
+By: ProgrammingIncluded
+"""
+# std
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, Union
+
+# tb_watcher
+from tb_watcher.settings import CrawlSettings
+from tb_watcher.math_utils import make_offset_func
+from tb_watcher.budget import BUDGET
+from tb_watcher.threading import add_job, current_priority
+from tb_watcher.driver_utils import Tweet, apply_resource_policy
+from tb_watcher.pages import TwitterThread
+
+# selenium
+from selenium import webdriver
+
+@dataclass(init=True, repr=True)
+class ProfileJob:
+    """A profile to snapshot."""
+    url: str
+
+@dataclass(init=True, repr=True)
+class ThreadJob:
+    """A thread to archive, spawned from a tweet of a profile or of another thread."""
+    url: str
+    root_dir: str
+    fetch_threads: int
+    max_captures: int
+    load_time: float
+    main_tweet: Tweet
+    prior_tweet: Union[Tweet, None]
+    settings: CrawlSettings
+    # The main tweet resolved with its screenshot taken, if the spawning page already did so.
+    metadata: Union[Tweet, None] = None
+    # Threads followed from the profile to reach this one.
+    depth: int = 1
+
+    def run(self, driver: webdriver, offset_func: Callable = None):
+        """
+        Archives the thread with driver, navigating to it unless it is already there.
+        Without offset_func, the one described by settings is used.
+        """
+        if offset_func is None:
+            offset_func = make_offset_func(self.settings.scroll_algorithm, self.settings.scroll_value)
+
+        tt = TwitterThread(
+            self.main_tweet,
+            self.prior_tweet,
+            self.root_dir,
+            self.url,
+            fetch_threads=self.fetch_threads,
+            existing_driver=driver,
+            settings=self.settings,
+            metadata=self.metadata,
+            depth=self.depth)
+        tt.fetch_tweets(
+            self.max_captures,
+            self.load_time,
+            offset_func
+        )
+
+# When set, thread jobs are handed to it instead of the local executor.
+THREAD_JOB_FORWARDER = None
+
+def forward_thread_jobs(forwarder: Union[Callable[[ThreadJob], None], None]):
+    """Hands every thread job submitted from now on to forwarder, e.g. to send them to another process."""
+    global THREAD_JOB_FORWARDER
+    THREAD_JOB_FORWARDER = forwarder
+
+def submit_thread_job(job: ThreadJob, driver: webdriver, offset_func: Callable, open_tab: bool) -> Union[Future, None]:
+    """
+    Queues a thread job on the executor, or forwards it if a forwarder is set.
+    Run on a worker, the job leases a driver from the pool. Run on the caller's
+    thread, it uses driver, in a new tab if open_tab or in its current window otherwise.
+    """
+    if THREAD_JOB_FORWARDER is not None:
+        THREAD_JOB_FORWARDER(job)
+        return None
+
+    # Spawn a new thread and leave it.
+    def _new_thread(is_new_thread: bool):
+        # Lazy load, the pool depends on driver_utils.
+        from tb_watcher.driver_pool import get_driver_pool
+
+        if not BUDGET.admits(job.depth):
+            return
+
+        if is_new_thread:
+            with get_driver_pool().leased() as new_driver:
+                job.run(new_driver, offset_func)
+        elif open_tab:
+            window_before = driver.current_window_handle
+            driver.switch_to.new_window("tab")
+            try:
+                apply_resource_policy(driver)
+                job.run(driver, offset_func)
+            finally:
+                driver.close()
+                driver.switch_to.window(window_before)
+        else:
+            job.run(driver, offset_func)
+
+    # Shallower threads first, then in order of their profile.
+    return add_job(_new_thread, priority=(job.depth,) + current_priority()[1:])
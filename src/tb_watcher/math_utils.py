@@ -37,3 +37,12 @@ def constant(const: float) -> Callable:
     def _func(lst):
         return const
     return _func
+
+def make_offset_func(algorithm: str, value: float) -> Callable:
+    """Returns the scroll offset function for a --scroll-algorithm and --scroll-value."""
+    if algorithm == "percentile":
+        assert value <= 1.0 and value >= 0.0
+        return calc_average_percentile(value)
+    elif algorithm == "window":
+        return window_average(value)
+    return constant(value)
@@ -0,0 +1,169 @@
+"""
+Packs the folder of a profile into one tar file, so an archive holds a few files per profile instead of one per tweet.
+A side index gives the offset of every file in the tar, so any of them can be read without scanning it.
+
+By: ProgrammingIncluded
+"""
+# std
+import os
+import json
+import shutil
+import tarfile
+
+from typing import Dict, List, Tuple, Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.storage import atomic_write_json
+
+PACK_EXT = ".tar"
+PACK_INDEX_EXT = ".tar.idx"
+
+# Files needed to update a packed profile, see unpack_text().
+TEXT_EXTS = (".json", ".jsonl")
+
+def pack_fpath(folder: str) -> str:
+    return os.path.normpath(folder) + PACK_EXT
+
+def index_fpath(pack: str) -> str:
+    return pack[:-len(PACK_EXT)] + PACK_INDEX_EXT
+
+def is_packed(folder: str) -> bool:
+    return os.path.exists(pack_fpath(folder))
+
+def load_pack_index(pack: str) -> dict:
+    """Returns the end of the tar and, by name, the data offset, size and mtime in ns of every file in it."""
+    fpath = index_fpath(pack)
+    if not os.path.exists(fpath):
+        return {"end": 0, "members": {}}
+    with open(fpath, encoding="utf-8") as f:
+        return json.load(f)
+
+def pack_folder(folder: str, remove: bool = True) -> Dict[str, int]:
+    """
+    Appends the files of folder missing from, or changed since, its pack to <folder>.tar, then removes folder.
+    A file appended again replaces the earlier one in the index, as it does for tar.
+    Returns the number of files and bytes appended.
+    """
+    pack = pack_fpath(folder)
+    index = load_pack_index(pack)
+    members = index["members"]
+
+    added, added_bytes = 0, 0
+    with open(pack, "r+b" if os.path.exists(pack) else "wb") as f:
+        # Anything after the indexed end is the end of archive marker, or was left by an interrupted pack.
+        f.seek(index["end"])
+        f.truncate()
+        with tarfile.open(fileobj=f, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for dirpath, dirnames, fnames in os.walk(folder):
+                dirnames.sort()
+                for fname in sorted(fnames):
+                    if fname.endswith(".tmp"):
+                        continue
+
+                    fpath = os.path.join(dirpath, fname)
+                    name = os.path.relpath(fpath, folder).replace(os.sep, "/")
+                    stat = os.stat(fpath)
+                    if members.get(name, [None, None, None])[1:] == [stat.st_size, stat.st_mtime_ns]:
+                        continue
+
+                    info = tar.gettarinfo(fpath, arcname=name)
+                    # Screenshots hardlinked to the same blob would be packed as links without data.
+                    info.type = tarfile.REGTYPE
+                    info.linkname = ""
+                    info.size = stat.st_size
+
+                    with open(fpath, "rb") as data:
+                        tar.addfile(info, data)
+                    # Data is padded to whole blocks, and the header before it may span several.
+                    blocks = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    members[name] = [tar.offset - blocks, stat.st_size, stat.st_mtime_ns]
+                    added += 1
+                    added_bytes += info.size
+
+            # Closing writes the end of archive marker, which the next pack writes over.
+            index["end"] = tar.offset
+        f.flush()
+        os.fsync(f.fileno())
+
+    atomic_write_json(index_fpath(pack), index)
+
+    if remove:
+        shutil.rmtree(folder)
+    return {"files": added, "bytes": added_bytes}
+
+class PackReader:
+    """Reads files out of a pack through its index."""
+    def __init__(self, pack: str):
+        self.pack = pack
+        self.members: Dict[str, List[int]] = load_pack_index(pack)["members"]
+
+    def names(self) -> List[str]:
+        return sorted(self.members.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.members
+
+    def read(self, name: str) -> bytes:
+        offset, size, _ = self.members[name]
+        with open(self.pack, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def extract(self, folder: str, exts: Tuple[str] = None) -> int:
+        """Writes the files of the pack ending with one of exts, or all of them, under folder. Returns how many."""
+        extracted = 0
+        for name, (_, _, mtime_ns) in self.members.items():
+            if exts is not None and not name.endswith(exts):
+                continue
+
+            fpath = os.path.join(folder, *name.split("/"))
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            with open(fpath, "wb") as f:
+                f.write(self.read(name))
+            # Unchanged files are then skipped when packing again.
+            os.utime(fpath, ns=(mtime_ns, mtime_ns))
+            extracted += 1
+        return extracted
+
+def unpack_text(folder: str) -> int:
+    """Restores the json files of a packed folder, which is all updating it needs. Returns how many."""
+    return PackReader(pack_fpath(folder)).extract(folder, TEXT_EXTS)
+
+def remove_pack(folder: str):
+    pack = pack_fpath(folder)
+    for fpath in (pack, index_fpath(pack)):
+        if os.path.exists(fpath):
+            os.remove(fpath)
+
+def locate_packed(root_dir: str, rel: str) -> Union[Tuple[str, str], None]:
+    """Returns the pack holding rel, a path relative to the snapshots folder, and its name in it. None if not packed."""
+    profile, _, name = rel.partition("/")
+    pack = pack_fpath(os.path.join(root_dir, profile))
+    if not name or not os.path.exists(pack) or name not in PackReader(pack):
+        return None
+    return pack, name
+
+def profile_folders(root_dir: str) -> List[str]:
+    """Folders of the profiles archived in root_dir."""
+    folders = []
+    for fname in sorted(os.listdir(root_dir)):
+        folder = os.path.join(root_dir, fname)
+        if not fname.startswith(".") and os.path.exists(os.path.join(folder, "metadata.json")):
+            folders.append(folder)
+    return folders
+
+def pack_tree(root_dir: str, remove: bool = True) -> Dict[str, int]:
+    """Packs every profile folder of root_dir. Returns the number of profiles, files and bytes packed."""
+    totals = {"profiles": 0, "files": 0, "bytes": 0}
+    for folder in profile_folders(root_dir):
+        try:
+            stats = pack_folder(folder, remove)
+        except (OSError, tarfile.TarError) as e:
+            logger.error("Unable to pack {}: {}".format(folder, e))
+            continue
+
+        totals["profiles"] += 1
+        totals["files"] += stats["files"]
+        totals["bytes"] += stats["bytes"]
+    return totals
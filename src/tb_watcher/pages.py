@@ -7,9 +7,6 @@ By: ProgrammingIncluded
 """
 # std
 import os
-import random
-import time
-import json
 import shutil
 import threading
 
@@ -20,25 +17,46 @@ from urllib.parse import urlparse
 
 # tb_watcher
 from tb_watcher.logger import logger
+from tb_watcher.settings import CrawlSettings
+from tb_watcher.registry import VISITED
+from tb_watcher.budget import BUDGET
+from tb_watcher.storage import atomic_write_json
+from tb_watcher.screenshots import save_screenshot
+from tb_watcher.pack import is_packed, remove_pack, unpack_text
+from tb_watcher.readiness import wait_for_page_ready
 from tb_watcher.driver_utils import (BioMetadata, MaxCapturesReached, Scroller, TweetExtractor, Tweet,
-                                     ensures_or, remove_elements, create_chrome_driver, tweet_dom_get_basic_metadata)
+                                     ensures_or, create_chrome_driver, bulk_tweet_dom_get_metadata, page_observer_state,
+                                     drain_resource_log, record_page_resources)
 
 # selenium
 import selenium
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
 
 
 class TwitterPage:
     """Interface for a page on Twitter.
     Each page can allow for a driveer to optimize multi-threading.
     """
-    def __init__(self, root_dir: str, url: str, fetch_threads: int, existing_driver: webdriver = None):
+    # Used to report time-to-ready per type of page.
+    page_type = "page"
+
+    def __init__(
+        self,
+        root_dir: str,
+        url: str,
+        fetch_threads: int,
+        existing_driver: webdriver = None,
+        settings: CrawlSettings = None,
+        depth: int = 0):
         self.metadata = None
         self.root_dir = root_dir
+        # Where the page was archived, once it is.
+        self.folder = None
         self.fetch_threads = fetch_threads
+        self.settings = settings or CrawlSettings()
+        # Threads followed from the profile to reach this page.
+        self.depth = depth
 
         if existing_driver:
             self.driver = existing_driver
@@ -46,6 +64,17 @@ class TwitterPage:
             self.driver = create_chrome_driver()
         self.url = url
 
+    def on_page(self) -> bool:
+        """True if the driver is on this page already, even if Twitter redirected it to another host."""
+        current = urlparse(self.driver.current_url).path.rstrip("/").lower()
+        return current == urlparse(self.url).path.rstrip("/").lower()
+
+    def load(self):
+        """Navigates to the page, charging the crawl budget."""
+        BUDGET.charge_page()
+        drain_resource_log(self.driver)
+        self.driver.get(self.url)
+
     def get_driver(self) -> webdriver:
         """
         Returns the driver for a given page.
@@ -64,14 +93,19 @@ class TwitterPage:
         load_time: int,
         offset_func: Callable
     ) -> List[Tweet]:
-        if self.url not in self.driver.current_url:
-            self.driver.get(self.url)
+        navigated = False
+        if not self.on_page():
+            self.load()
+            navigated = True
 
         if self.metadata is None:
             self.fetch_metadata()
+        elif navigated:
+            wait_for_page_ready(self.driver, self.page_type, self.settings)
 
         save_path = os.path.join(self.root_dir, self.metadata.unique_id())
-        extractor = TweetExtractor(save_path, number_posts_to_cap)
+        focal_id = self.metadata.id if isinstance(self.metadata, Tweet) else None
+        extractor = TweetExtractor(save_path, number_posts_to_cap, focal_id=focal_id, settings=self.settings, depth=self.depth)
         # Skip the first tweet of a thread current metadata applies.
         # Which only occurs in threads.
         extractor.tweets_tracker.add(self.metadata)
@@ -80,17 +114,29 @@ class TwitterPage:
         last_id = 0
         # Wrap the offset function with extract height context.
         try:
-            time.sleep(random.uniform(load_time, load_time + 2))
-            for _ in Scroller(self.driver, extractor.create_offset_function(offset_func), load_time):
+            scroller = Scroller(
+                self.driver,
+                extractor.create_offset_function(offset_func),
+                load_time,
+                adaptive=self.settings.adaptive_scroll,
+                settle=self.settings.ready_quiet)
+            for _ in scroller:
+                # Profiles always finish, deeper levels give way once the budget runs out.
+                if self.depth > 0 and BUDGET.exhausted():
+                    logger.debug("Crawl budget exhausted, stopping thread early.")
+                    break
+
                 if last_id_count > 5:
                     logger.debug("No more data to load?")
                     break
 
                 # Just in case we keep hitting the same id.
-                if last_id == extractor.counter:
+                # Archived tweets skipped by an incremental crawl are progress too.
+                seen = extractor.counter + extractor.known_count
+                if last_id == seen:
                     last_id_count += 1
                 else:
-                    last_id = extractor.counter
+                    last_id = seen
                     last_id_count = 0
 
                 # Capture the tweets and generates files for them
@@ -104,8 +150,21 @@ class TwitterPage:
         except Exception as e:
             raise e
         finally:
+            logger.debug("Resolved {} tweets from the timeline, {} through tab fallback.".format(
+                extractor.resolved_count, extractor.fallback_count))
+            logger.debug("{} WebDriver round-trips for {} tweets.".format(extractor.round_trips, extractor.counter))
+            if self.settings.prune_dom:
+                logger.debug("Pruned {} archived tweets from the page.".format(extractor.pruned_count))
+            if self.settings.incremental:
+                logger.debug("Skipped {} archived tweets.".format(extractor.known_count))
+            if extractor.viewport is not None:
+                logger.debug("Cropped {} tweets out of {} viewport captures, {} did not fit.".format(
+                    extractor.viewport.crops, extractor.viewport.captures, extractor.viewport.misses))
             # Dump all metadata
             extractor.write_json()
+            record_page_resources(self.driver, self.page_type)
+
+        return extractor.tweets_ordered
 
 class TwitterThread(TwitterPage):
     """
@@ -113,33 +172,31 @@ class TwitterThread(TwitterPage):
     Also used to resolve Tweet ID as a thread will contain
     the Tweet's ID.
     """
-    def __init__(self, main_tweet_data: Tweet, prior_tweet_data: Tweet, *args, **kwargs):
+    page_type = "thread"
+
+    def __init__(self, main_tweet_data: Tweet, prior_tweet_data: Tweet, *args, metadata: Tweet = None, **kwargs):
         self.main_tweet_data = main_tweet_data
         self.prior_tweet_data = prior_tweet_data
         # Force auto fetching threads to false to prevent recursion.
         super().__init__(*args, **kwargs)
+        # Already resolved with its screenshot taken, fetch_tweets() then only loads the page once.
+        self.metadata = metadata
 
     def fetch_metadata(self) -> Tweet:
         raw_url = self.driver.current_url
-        if self.url not in raw_url:
-            self.driver.get(self.url)
+        if not self.on_page():
+            self.load()
             raw_url = self.url
 
-        state = ""
-        while state != "complete":
-            time.sleep(random.uniform(3, 5))
-            state = self.driver.execute_script("return document.readyState")
-
-        WebDriverWait(self.driver, 30).until(EC.presence_of_element_located(
-            (By.CSS_SELECTOR, '[data-testid="tweet"]')))
+        wait_for_page_ready(self.driver, self.page_type, self.settings)
 
-        tweets = self.driver.find_elements(By.CSS_SELECTOR, '[data-testid="tweet"]')
+        tweets = bulk_tweet_dom_get_metadata(self.driver)
 
         main_tweet = None
         parent_id = None
         # Not every tweet on the metadata we want. Keep iterating until we find it.
         for t in tweets:
-            dtm = tweet_dom_get_basic_metadata(t)
+            dtm = t.tweet
             # Check if this tweet is a parent, if so, we can mark it as a parent tweet.
             if self.prior_tweet_data and \
                dtm.name == self.prior_tweet_data.name and \
@@ -149,7 +206,7 @@ class TwitterThread(TwitterPage):
             # Some forms don't exist in thread.
             if dtm.name == self.main_tweet_data.name and \
                dtm.tweet_text == self.main_tweet_data.tweet_text:
-                main_tweet = t
+                main_tweet = t.element
                 break
 
         assert main_tweet is not None, "There should be a valid tweet in thread page."
@@ -171,14 +228,12 @@ class TwitterThread(TwitterPage):
         tweet_folder_fpath = os.path.join(self.root_dir, dtm.id)
         os.makedirs(tweet_folder_fpath, exist_ok=True)
 
-        # Remove initial popups.
-        remove_elements(self.driver, ["sheetDialog", "confirmationSheetDialog", "mask"])
-
-        # delete bottom element
-        remove_elements(self.driver, ["BottomBar"])
+        # Remove popups and the bottom bar, now and whenever they come back.
+        page_observer_state(self.driver)
 
-        # Take a screenshot of the tweet.
-        main_tweet.screenshot(os.path.join(tweet_folder_fpath, "{}.png".format(dtm.id)))
+        # Take a screenshot of the tweet, unless another page did.
+        if VISITED.claim_screenshot(tweet_folder_fpath, dtm.id):
+            save_screenshot(os.path.join(tweet_folder_fpath, "{}.png".format(dtm.id)), main_tweet.screenshot_as_png)
         return dtm
 
 
@@ -186,23 +241,16 @@ class TwitterBio(TwitterPage):
     """
     Class encapsulating a twitter bio page.
     """
-    def fetch_metadata(self) -> BioMetadata:
-        if self.url not in self.driver.current_url:
-            self.driver.get(self.url)
-
-        state = ""
-        while state != "complete":
-            time.sleep(random.uniform(3, 5))
-            state = self.driver.execute_script("return document.readyState")
+    page_type = "bio"
 
-        WebDriverWait(self.driver, 30).until(EC.presence_of_element_located(
-            (By.CSS_SELECTOR, '[data-testid="tweet"]')))
+    def fetch_metadata(self) -> BioMetadata:
+        if not self.on_page():
+            self.load()
 
-        # Remove initial popups.
-        remove_elements(self.driver, ["sheetDialog", "confirmationSheetDialog", "mask"])
+        wait_for_page_ready(self.driver, self.page_type, self.settings)
 
-        # delete bottom element
-        remove_elements(self.driver, ["BottomBar"])
+        # Remove popups and the bottom bar, now and whenever they come back.
+        page_observer_state(self.driver)
 
         metadata = {}
         metadata["bio"] = ensures_or(lambda: self.driver.find_element(By.CSS_SELECTOR,'div[data-testid="UserDescription"]').text)
@@ -226,25 +274,35 @@ class TwitterBio(TwitterPage):
     def write_json(self, force=False) -> bool:
         """
         Returns true if wrote to file, otherwise returns false.
+        In incremental mode an existing folder is updated instead of skipped.
         """
         username = self.metadata.username
         assert self.metadata.username[0] == "@"
         username = username[1:]
 
         fpath = os.path.join(self.root_dir, username)
-        if not force and os.path.exists(fpath):
+        packed = is_packed(fpath)
+        if self.settings.incremental and (os.path.exists(fpath) or packed):
+            logger.info("Folder already exists, fetching new tweets: {}".format(fpath))
+            # Archived tweets are read from the json files, a folder left by an interrupted run is newer.
+            if packed and not os.path.exists(fpath):
+                unpack_text(fpath)
+        elif not force and (os.path.exists(fpath) or packed):
             logger.info("Folder already exists, skipping: {}".format(fpath))
             return False
-        elif force and os.path.exists(fpath):
-            shutil.rmtree(fpath)
+        elif force:
+            if os.path.exists(fpath):
+                shutil.rmtree(fpath)
+            if packed:
+                remove_pack(fpath)
 
-        os.makedirs(fpath)
+        os.makedirs(fpath, exist_ok=True)
 
         # Force utf-8
         # Save a copy of the metadata
-        with open(os.path.join(fpath, "metadata.json"), "w", encoding="utf-8") as f:
-            json.dump(self.get_bio_as_dict(), f, ensure_ascii=False)
+        atomic_write_json(os.path.join(fpath, "metadata.json"), self.get_bio_as_dict())
 
+        self.folder = fpath
         # Save a screen shot of the bio
-        self.driver.save_screenshot(os.path.join(fpath, "profile.png"))
+        save_screenshot(os.path.join(fpath, "profile.png"), self.driver.get_screenshot_as_png())
         return True
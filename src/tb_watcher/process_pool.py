@@ -0,0 +1,331 @@
+"""
+Runs crawl jobs in worker processes, each owning its driver.
+A wedged or crashed worker only loses its current job, which is retried on a new worker.
+
+By: ProgrammingIncluded
+"""
+# std
+import os
+import time
+import heapq
+import signal
+import multiprocessing
+
+from dataclasses import dataclass, replace
+from queue import Empty
+from typing import Dict, List, Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.core import ProfileSummary, pack_profile
+from tb_watcher.jobs import ProfileJob, ThreadJob
+from tb_watcher.registry import VISITED, log_visited_report
+from tb_watcher.budget import BUDGET
+from tb_watcher.sharding import acquire_profile, release_profile
+
+# Seconds between two checks of the workers' health.
+HEALTH_CHECK_INTERVAL = 1.0
+
+@dataclass(init=True, repr=True)
+class QueuedJob:
+    """A job along with what the parent process tracks for it."""
+    id: int
+    job: Union[ProfileJob, ThreadJob]
+    # Index of the profile the job belongs to, used for summaries.
+    profile: int
+    depth: int = 0
+    attempts: int = 0
+    started_at: float = None
+
+def worker_main(worker_id: int, inbox, outbox, crawl_args: dict, log_level: int, chromedriver: str, max_pages: int):
+    """
+    Entry point of a worker process.
+    Runs jobs from inbox and reports to outbox, thread jobs it spawns are sent to the parent.
+    """
+    # Imported here so they are loaded in the worker, not pickled from the parent.
+    from tb_watcher.core import fetch_profile
+    from tb_watcher.jobs import forward_thread_jobs
+    from tb_watcher.math_utils import make_offset_func
+    from tb_watcher.threading import spawn_threads
+    from tb_watcher.driver_pool import init_driver_pool
+    from tb_watcher.chromedriver import resolve_chromedriver_path
+    from tb_watcher.index import init_index
+    from tb_watcher.resources import set_resource_policy, log_resource_report
+    from tb_watcher.screenshots import SCREENSHOTS, log_screenshot_report
+
+    # Chromedriver and Chrome join the group, so killing it leaves none of them behind.
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+
+    logger.setLevel(log_level)
+    resolve_chromedriver_path(chromedriver)
+    settings = crawl_args["settings"]
+    set_resource_policy(settings.resource_policy, settings.blocked_urls, settings.resource_stats)
+    pool = init_driver_pool(1, max_pages=max_pages, warm=True)
+
+    # Everything runs on this thread, thread jobs are spread by the parent.
+    spawn_threads(1)
+    current = {"job": None}
+    forward_thread_jobs(lambda job: outbox.put(("spawn", worker_id, current["job"], job)))
+
+    SCREENSHOTS.configure(
+        settings.screenshot_writers,
+        image_format=settings.screenshot_format,
+        fsync=settings.screenshot_fsync,
+        store_dir=settings.screenshot_store)
+    if settings.index_db:
+        init_index(crawl_args["fpath"], settings.index_db)
+    offset_func = make_offset_func(settings.scroll_algorithm, settings.scroll_value)
+    try:
+        while True:
+            item = inbox.get()
+            if item is None:
+                return
+
+            job_id, job, attempts, max_pages, max_seconds = item
+            current["job"] = job_id
+            # What is left of the crawl budget, so long scrolls stop once it runs out.
+            BUDGET.configure(max_pages, max_seconds)
+            # A retried job keeps what an earlier attempt archived and fetches the rest.
+            job_settings = settings
+            if attempts > 1:
+                job_settings = replace(settings, incremental=True, known_stop=0)
+            outbox.put(("started", worker_id, job_id))
+            try:
+                result = {}
+                with pool.leased() as driver:
+                    if isinstance(job, ProfileJob):
+                        profile_args = dict(crawl_args, settings=job_settings)
+                        summary = fetch_profile(driver, job.url, offset_func=offset_func, **profile_args)
+                        result = {"tweets": summary.tweets, "skipped": summary.skipped, "folder": summary.folder}
+                    else:
+                        replace(job, settings=job_settings).run(driver, offset_func)
+                error = None
+                # The parent may pack the profile once told the job is done.
+                SCREENSHOTS.flush()
+            except Exception as e:
+                logger.exception("Job failed: {}".format(e))
+                result, error = None, str(e)
+            outbox.put(("done", worker_id, job_id, attempts, result, error, BUDGET.report()["pages"]))
+    finally:
+        pool.shutdown()
+        SCREENSHOTS.shutdown()
+        log_screenshot_report()
+        log_resource_report(settings.resource_baseline)
+
+def kill_worker(process: multiprocessing.Process):
+    """Kills a worker process along with the chromedriver and Chrome processes of its group."""
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+            return
+        except ProcessLookupError:
+            # Not its own group yet, or every process of it is gone.
+            pass
+    if process.is_alive():
+        process.terminate()
+
+class ProcessCrawlPool:
+    """
+    Spreads profile and thread jobs over worker processes.
+    Jobs are handed to idle workers one at a time, shallowest first, so the parent always knows
+    which job a worker holds. If a worker dies, or takes more than job_timeout
+    seconds on a job, it is restarted and its job retried up to max_retries times.
+    Once the crawl budget runs out, queued jobs are dropped.
+    """
+    def __init__(
+        self,
+        num_workers: int,
+        crawl_args: dict,
+        chromedriver: str = None,
+        max_pages: int = 50,
+        max_retries: int = 2,
+        job_timeout: float = 0):
+        assert num_workers >= 1, "There should be atleast one worker process."
+        self.num_workers = num_workers
+        self.crawl_args = crawl_args
+        self.chromedriver = chromedriver
+        self.max_pages = max_pages
+        self.max_retries = max_retries
+        self.job_timeout = job_timeout
+
+        # Processes are spawned so no selenium or thread state is inherited.
+        self.ctx = multiprocessing.get_context("spawn")
+        self.outbox = None
+        self.workers: Dict[int, tuple] = {}
+        self.running: Dict[int, QueuedJob] = {}
+        self.restarts = 0
+
+    def start_worker(self, worker_id: int):
+        inbox = self.ctx.Queue()
+        process = self.ctx.Process(
+            target=worker_main,
+            args=(worker_id, inbox, self.outbox, self.crawl_args, logger.level, self.chromedriver, self.max_pages),
+            name="tbw-process-{}".format(worker_id),
+            daemon=True)
+        process.start()
+        self.workers[worker_id] = (process, inbox)
+
+    def run(self, urls: List[str]) -> List[ProfileSummary]:
+        """Snapshots every profile and the threads they spawn. Blocks until all are done."""
+        self.outbox = self.ctx.Queue()
+        summaries = [ProfileSummary(url) for url in urls]
+        started_at: Dict[int, float] = {}
+        finished_at: Dict[int, float] = {}
+
+        jobs = {i: QueuedJob(i, ProfileJob(url), i) for i, url in enumerate(urls)}
+        # Shallowest first, then in order of profile and discovery.
+        queued = [(q.depth, q.profile, q.id, q) for q in jobs.values()]
+        heapq.heapify(queued)
+        next_id = len(urls)
+        done = 0
+
+        # Jobs queued or running per profile, its lease is released once none are left.
+        outstanding = {i: 1 for i in range(len(urls))}
+        def _settled(q: QueuedJob):
+            if q.profile < 0:
+                return
+            outstanding[q.profile] -= 1
+            if outstanding[q.profile] == 0:
+                pack_profile(summaries[q.profile].folder, self.crawl_args["settings"])
+                release_profile(urls[q.profile])
+
+        for worker_id in range(self.num_workers):
+            self.start_worker(worker_id)
+        idle = set(self.workers.keys())
+
+        try:
+            while queued or self.running:
+                while idle and queued:
+                    q = heapq.heappop(queued)[-1]
+                    is_profile = isinstance(q.job, ProfileJob)
+                    # Retried profiles hold their lease already.
+                    if not BUDGET.admits(q.depth) or (is_profile and q.attempts == 0 and not acquire_profile(q.job.url)):
+                        if is_profile:
+                            summaries[q.profile].skipped = True
+                        _settled(q)
+                        continue
+
+                    worker_id = idle.pop()
+                    q.attempts += 1
+                    q.started_at = time.perf_counter()
+                    self.running[worker_id] = q
+                    self.workers[worker_id][1].put((q.id, q.job, q.attempts) + BUDGET.remaining())
+
+                try:
+                    message = self.outbox.get(timeout=HEALTH_CHECK_INTERVAL)
+                except Empty:
+                    message = None
+
+                if message is not None:
+                    kind, worker_id = message[0], message[1]
+                    if kind == "spawn":
+                        _, _, parent_id, job = message
+                        # Workers only know the threads they visited themselves.
+                        if job.metadata is not None and not VISITED.claim_thread(job.metadata.id):
+                            logger.debug("Thread {} already visited, skipping.".format(job.metadata.id))
+                            continue
+
+                        parent = jobs.get(parent_id)
+                        q = QueuedJob(next_id, job, parent.profile if parent else -1, job.depth)
+                        jobs[q.id] = q
+                        heapq.heappush(queued, (q.depth, q.profile, q.id, q))
+                        next_id += 1
+                        if parent is not None:
+                            summaries[parent.profile].thread_jobs += 1
+                            outstanding[parent.profile] += 1
+                    elif kind == "started":
+                        q = jobs[message[2]]
+                        started_at.setdefault(q.profile, time.perf_counter())
+                    elif kind == "done":
+                        _, _, job_id, attempts, result, error, pages = message
+                        BUDGET.charge_page(pages)
+                        # Sent by a worker restarted since, its job was retried or given up already.
+                        q = self.running.get(worker_id)
+                        if q is None or q.id != job_id or q.attempts != attempts:
+                            logger.debug("Ignoring stale result of job {} from worker {}.".format(job_id, worker_id))
+                            continue
+
+                        del self.running[worker_id]
+                        idle.add(worker_id)
+                        done += 1
+                        self.job_finished(q, result, error, summaries, finished_at)
+                        _settled(q)
+                        logger.info("Progress: {} jobs done, {} running, {} queued.".format(
+                            done, len(self.running), len(queued)))
+
+                for worker_id in self.check_workers():
+                    q = self.running.pop(worker_id, None)
+                    idle.add(worker_id)
+                    if q is None:
+                        continue
+
+                    if q.attempts <= self.max_retries:
+                        logger.warning("Retrying job {} ({}/{}): {}".format(q.id, q.attempts, self.max_retries, q.job))
+                        heapq.heappush(queued, (q.depth, q.profile, q.id, q))
+                    else:
+                        done += 1
+                        self.job_finished(q, None, "worker crashed", summaries, finished_at)
+                        _settled(q)
+        finally:
+            self.shutdown()
+
+        for i, summary in enumerate(summaries):
+            if i in started_at and i in finished_at:
+                summary.seconds = finished_at[i] - started_at[i]
+
+        logger.info("Worker processes restarted {} times.".format(self.restarts))
+        log_visited_report()
+        return summaries
+
+    def job_finished(self, q: QueuedJob, result: dict, error: str, summaries: List[ProfileSummary], finished_at: Dict[int, float]):
+        if q.profile < 0:
+            return
+
+        summary = summaries[q.profile]
+        finished_at[q.profile] = time.perf_counter()
+        if isinstance(q.job, ProfileJob):
+            if error is not None:
+                summary.error = error
+                summary.failures += 1
+            else:
+                summary.tweets = result["tweets"]
+                summary.skipped = result["skipped"]
+                summary.folder = result["folder"]
+        elif error is not None:
+            summary.failures += 1
+
+    def check_workers(self) -> List[int]:
+        """Restarts dead or wedged workers, returning their ids."""
+        restarted = []
+        now = time.perf_counter()
+        for worker_id, (process, _) in list(self.workers.items()):
+            q = self.running.get(worker_id)
+            wedged = self.job_timeout and q is not None and now - q.started_at > self.job_timeout
+            if process.is_alive() and not wedged:
+                continue
+
+            if wedged:
+                logger.warning("Worker {} took over {}s on job {}, restarting it.".format(worker_id, self.job_timeout, q.id))
+            else:
+                logger.warning("Worker {} died with exit code {}, restarting it.".format(worker_id, process.exitcode))
+            # A dead worker may still leave its Chrome running.
+            kill_worker(process)
+            process.join()
+
+            self.restarts += 1
+            self.start_worker(worker_id)
+            restarted.append(worker_id)
+        return restarted
+
+    def shutdown(self):
+        for process, inbox in self.workers.values():
+            if process.is_alive():
+                inbox.put(None)
+
+        for process, _ in self.workers.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                kill_worker(process)
+                process.join()
+        self.workers = {}
@@ -0,0 +1,139 @@
+"""
+Waits for pages to be ready instead of sleeping a fixed amount of time.
+By: ProgrammingIncluded
+"""
+# std
+import time
+import random
+import threading
+
+from typing import Dict, List, Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.settings import CrawlSettings
+
+# selenium
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+
+# Seconds between two probes of the page.
+POLL_INTERVAL = 0.1
+
+# Resources loaded by the page so far, counted by an observer installed on first use.
+# The resource timing buffer stops at 250 entries, which a scrolled timeline soon fills.
+RESOURCE_COUNT_EXPRESSION = """
+    (() => {
+        if (window.tbwResourceCount === undefined) {
+            window.tbwResourceCount = 0;
+            new PerformanceObserver(list => { window.tbwResourceCount += list.getEntries().length; })
+                .observe({type: 'resource', buffered: true});
+        }
+        return window.tbwResourceCount;
+    })()
+"""
+
+# Everything needed to decide if a page is ready, in one round-trip.
+# Completed resources and the page height are compared between probes
+# to tell if the network is quiet and the layout is stable.
+READY_PROBE_SCRIPT = """
+    return {
+        state: document.readyState,
+        tweets: document.querySelectorAll('[data-testid="tweet"]').length,
+        resources: %s,
+        height: document.body ? document.body.scrollHeight : 0
+    };
+""" % RESOURCE_COUNT_EXPRESSION
+
+READY_LOCK = threading.Lock()
+READY_TIMES: Dict[str, List[float]] = {}
+
+def wait_for_page_ready(driver: webdriver, page_type: str, settings: CrawlSettings = None) -> float:
+    """
+    Waits until the page has a tweet, no new resources and a stable height for settings.ready_quiet seconds.
+    Gives up after settings.ready_timeout seconds, raising a TimeoutException if no tweet was found.
+
+    Returns:
+        float: Seconds until the page was ready, excluding jitter.
+    """
+    settings = settings or CrawlSettings()
+    start = time.perf_counter()
+    deadline = start + settings.ready_timeout
+
+    last_signature = None
+    quiet_since = start
+    while True:
+        probe = driver.execute_script(READY_PROBE_SCRIPT)
+        now = time.perf_counter()
+
+        signature = (probe["resources"], probe["height"])
+        has_content = probe["state"] == "complete" and probe["tweets"] > 0
+        if not has_content or signature != last_signature:
+            quiet_since = now
+        last_signature = signature
+
+        if has_content and now - quiet_since >= settings.ready_quiet:
+            break
+
+        if now >= deadline:
+            if not has_content:
+                raise TimeoutException("No tweets loaded after {}s on {}.".format(settings.ready_timeout, page_type))
+
+            logger.debug("Page {} still loading after {}s, continuing.".format(page_type, settings.ready_timeout))
+            break
+
+        time.sleep(POLL_INTERVAL)
+
+    elapsed = time.perf_counter() - start
+    with READY_LOCK:
+        READY_TIMES.setdefault(page_type, []).append(elapsed)
+    logger.debug("Page {} ready in {:.2f}s.".format(page_type, elapsed))
+
+    # Be polite, some pages do not need to be hit as fast as possible.
+    if settings.ready_jitter > 0:
+        time.sleep(random.uniform(0, settings.ready_jitter))
+
+    return elapsed
+
+def ready_report() -> Dict[str, dict]:
+    """Returns the count, mean and max time-to-ready per page type."""
+    with READY_LOCK:
+        return {
+            page_type: {"count": len(times), "mean": sum(times) / len(times), "max": max(times)}
+            for page_type, times in READY_TIMES.items()
+        }
+
+class LoadLatency:
+    """
+    Exponential moving average of how long new content takes to show up.
+    Shared by every page of a session, so it is thread-safe.
+    """
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.value = None
+        self.samples = 0
+
+    def add(self, seconds: float):
+        with self.lock:
+            if self.value is None:
+                self.value = seconds
+            else:
+                self.value = self.alpha * seconds + (1 - self.alpha) * self.value
+            self.samples += 1
+
+    def typical(self) -> Union[float, None]:
+        """Returns None until a sample has been added."""
+        with self.lock:
+            return self.value
+
+SCROLL_LATENCY = LoadLatency()
+
+def log_ready_report():
+    for page_type, stats in sorted(ready_report().items()):
+        logger.info("Time to ready for {} pages: {:.2f}s mean, {:.2f}s max over {} pages.".format(
+            page_type, stats["mean"], stats["max"], stats["count"]))
+
+    if SCROLL_LATENCY.samples > 0:
+        logger.info("Typical scroll load latency: {:.2f}s over {} scrolls.".format(
+            SCROLL_LATENCY.typical(), SCROLL_LATENCY.samples))
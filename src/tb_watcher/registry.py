@@ -0,0 +1,62 @@
+"""
+Crawl-wide registry of visited tweets, so threads reached from several pages are only crawled once.
+By: ProgrammingIncluded
+"""
+# std
+import os
+import threading
+
+from typing import Set, Tuple
+
+# tb_watcher
+from tb_watcher.logger import logger
+
+class VisitedRegistry:
+    """
+    Tweet ids whose thread was queued or whose screenshot was taken, shared by every page of a crawl.
+    Claiming an id is atomic, so of two threads reaching the same tweet only one does the work.
+    Screenshots are claimed per folder, as every folder a tweet is archived in keeps its own.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads: Set[str] = set()
+        self.screenshots: Set[Tuple[str, str]] = set()
+
+        self.skipped_threads = 0
+        self.skipped_screenshots = 0
+
+    def claim_thread(self, tweet_id: str) -> bool:
+        """Returns True if the thread of tweet_id was not claimed yet and is now the caller's to crawl."""
+        with self.lock:
+            if tweet_id in self.threads:
+                self.skipped_threads += 1
+                return False
+            self.threads.add(tweet_id)
+            return True
+
+    def claim_screenshot(self, folder: str, tweet_id: str) -> bool:
+        """Returns True if tweet_id was not captured into folder yet and is now the caller's to capture."""
+        key = (os.path.normpath(folder), tweet_id)
+        with self.lock:
+            if key in self.screenshots:
+                self.skipped_screenshots += 1
+                return False
+            self.screenshots.add(key)
+            return True
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "threads": len(self.threads),
+                "screenshots": len(self.screenshots),
+                "skipped_threads": self.skipped_threads,
+                "skipped_screenshots": self.skipped_screenshots,
+            }
+
+VISITED = VisitedRegistry()
+
+def log_visited_report():
+    report = VISITED.report()
+    # Every skipped thread is atleast one page load saved.
+    logger.info("Visited {} threads and captured {} tweets, skipped {} page loads and {} screenshots of duplicates.".format(
+        report["threads"], report["screenshots"], report["skipped_threads"], report["skipped_screenshots"]))
@@ -0,0 +1,161 @@
+"""
+Resources Chrome is kept from downloading, since archiving needs neither videos nor trackers, and text only runs no images.
+Also counts the requests made and blocked per page, and what a policy saves compared to a baseline run blocking nothing.
+
+By: ProgrammingIncluded
+"""
+# std
+import os
+import json
+import threading
+
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.storage import atomic_write_json
+
+# Analytics and tracking beacons.
+TRACKING_URLS = [
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*ads-twitter.com*",
+    "*ads-api.twitter.com*",
+    "*analytics.twitter.com*",
+    "*/i/jot*",
+    "*/1.1/jot/*",
+]
+
+# Videos and GIFs play as videos, their poster images still load.
+MEDIA_URLS = [
+    "*video.twimg.com*",
+    "*amp.twimg.com*",
+    "*.m3u8*",
+    "*.mp4*",
+    "*.m4s*",
+]
+
+FONT_URLS = ["*.woff*", "*.ttf*", "*.otf*"]
+
+IMAGE_URLS = ["*pbs.twimg.com*", "*.jpg*", "*.jpeg*", "*.png*", "*.gif*", "*.webp*", "*.svg*"]
+
+@dataclass(init=True, repr=True)
+class ResourcePolicy:
+    """URL patterns blocked in every tab, with * as wildcard, and what else Chrome is told not to load."""
+    name: str
+    blocked_urls: List[str] = field(default_factory=list)
+    # Blocks images by content setting as well, catching those the patterns miss.
+    block_images: bool = False
+    chrome_arguments: List[str] = field(default_factory=list)
+    # Logs the requests of every page to count them, which Chrome buffers for the whole page.
+    stats: bool = False
+
+QUIET_MEDIA_ARGUMENTS = ["--autoplay-policy=user-gesture-required", "--mute-audio"]
+
+PRESETS: Dict[str, ResourcePolicy] = {
+    "none": ResourcePolicy("none"),
+    # Tweets render as they would otherwise, without their videos.
+    "screenshots": ResourcePolicy("screenshots", TRACKING_URLS + MEDIA_URLS, chrome_arguments=QUIET_MEDIA_ARGUMENTS),
+    # Only text is read, e.g. for --bio-only or when screenshots do not matter.
+    "text": ResourcePolicy("text", TRACKING_URLS + MEDIA_URLS + FONT_URLS + IMAGE_URLS, block_images=True,
+                           chrome_arguments=QUIET_MEDIA_ARGUMENTS),
+}
+
+POLICY = PRESETS["none"]
+
+def set_resource_policy(preset: str, extra_urls: List[str] = None, stats: bool = False) -> ResourcePolicy:
+    """
+    Sets the policy applied to every driver created from now on. Returns it.
+    Requests are counted if anything is blocked, or if stats is set, e.g. to compare with blocking nothing.
+    """
+    global POLICY
+    assert preset in PRESETS, "Unknown resource policy: {}".format(preset)
+    base = PRESETS[preset]
+    blocked_urls = base.blocked_urls + list(extra_urls or [])
+    POLICY = ResourcePolicy(base.name, blocked_urls, base.block_images, list(base.chrome_arguments),
+                            stats or bool(blocked_urls) or base.block_images)
+    return POLICY
+
+def get_resource_policy() -> ResourcePolicy:
+    return POLICY
+
+@dataclass(init=True, repr=True)
+class PageResources:
+    """Requests made and blocked by pages of a type."""
+    pages: int = 0
+    requests: int = 0
+    bytes: int = 0
+    blocked: int = 0
+
+RESOURCES_LOCK = threading.Lock()
+RESOURCES: Dict[str, PageResources] = {}
+
+def count_log_entries(entries: List[dict]) -> PageResources:
+    """
+    Counts the finished and blocked requests of Chrome performance log entries.
+    Blocked requests are never sent, so their size is unknown.
+    """
+    counts = PageResources()
+    for entry in entries:
+        try:
+            message = json.loads(entry["message"])["message"]
+        except (KeyError, ValueError):
+            continue
+
+        method = message.get("method")
+        params = message.get("params", {})
+        if method == "Network.loadingFinished":
+            counts.requests += 1
+            counts.bytes += int(params.get("encodedDataLength", 0))
+        elif method == "Network.loadingFailed" and (
+                params.get("blockedReason") or params.get("errorText") == "net::ERR_BLOCKED_BY_CLIENT"):
+            counts.blocked += 1
+    return counts
+
+def record_resources(page_type: str, counts: PageResources):
+    with RESOURCES_LOCK:
+        total = RESOURCES.setdefault(page_type, PageResources())
+        total.pages += 1
+        total.requests += counts.requests
+        total.bytes += counts.bytes
+        total.blocked += counts.blocked
+    logger.debug("Page {} made {} requests, {:.1f}KB, {} blocked.".format(
+        page_type, counts.requests, counts.bytes / 1e3, counts.blocked))
+
+def log_resource_report(baseline_fpath: str = None):
+    """
+    Logs requests and bytes per page of each page type.
+    With baseline_fpath, a run blocking nothing writes its averages there, and runs with a policy
+    log what they saved per page compared to them. Blocked requests are never sent, so this is the only estimate.
+    """
+    with RESOURCES_LOCK:
+        totals = dict(RESOURCES)
+    for page_type, total in sorted(totals.items()):
+        logger.info("Resource policy {} on {} pages: {:.0f} requests, {:.2f}MB loaded and {:.0f} requests blocked per page.".format(
+            POLICY.name, page_type, total.requests / total.pages, total.bytes / total.pages / 1e6, total.blocked / total.pages))
+
+    if baseline_fpath is None or not totals:
+        return
+
+    averages = {page_type: {"pages": t.pages, "requests": t.requests / t.pages, "bytes": t.bytes / t.pages}
+                for page_type, t in totals.items()}
+    if not POLICY.blocked_urls and not POLICY.block_images:
+        atomic_write_json(baseline_fpath, averages)
+        logger.info("Wrote the resource baseline to {}.".format(baseline_fpath))
+        return
+
+    if not os.path.exists(baseline_fpath):
+        logger.info("No resource baseline at {}, run once with --resource-policy none to write it.".format(baseline_fpath))
+        return
+
+    with open(baseline_fpath, encoding="utf-8") as f:
+        baseline = json.load(f)
+    for page_type, average in sorted(averages.items()):
+        if page_type not in baseline:
+            continue
+        saved_requests = baseline[page_type]["requests"] - average["requests"]
+        saved_bytes = baseline[page_type]["bytes"] - average["bytes"]
+        logger.info("Resource policy {} on {} pages saved {:.0f} requests and {:.2f}MB per page, {:.1f}MB over {} pages.".format(
+            POLICY.name, page_type, saved_requests, saved_bytes / 1e6, saved_bytes * average["pages"] / 1e6, average["pages"]))
@@ -0,0 +1,327 @@
+"""
+Background writer of screenshots, so crawling threads only wait for Chrome to capture them.
+Captured PNG bytes are queued to a few writer threads which recompress them if asked and write them to disk.
+With a blob store, identical screenshots are stored once under their hash and hardlinked to where they belong.
+
+By: ProgrammingIncluded
+"""
+# std
+import io
+import os
+import errno
+import time
+import socket
+import hashlib
+import queue
+import threading
+
+from typing import Dict, List, Set, Tuple, Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+
+# As captured by Chrome, PNG optimized by Pillow, or lossless WebP by Pillow.
+FORMATS = ["png", "optimized", "webp"]
+
+BLOB_DIR = ".blobs"
+
+DEF_WRITERS = 2
+# Screenshots waiting to be written before capturing ones wait for room, about 64 tweets' worth of memory.
+DEF_MAX_QUEUED = 64
+
+def screenshot_fpath(fpath: str, image_format: str = "png") -> str:
+    """Path a screenshot requested at fpath, a .png, is written to in image_format."""
+    if image_format == "webp":
+        return os.path.splitext(fpath)[0] + ".webp"
+    return fpath
+
+def pillow_available() -> bool:
+    """Recompressing and cropping screenshots needs Pillow."""
+    try:
+        import PIL
+    except ImportError:
+        return False
+    return True
+
+def encode(png: bytes, image_format: str, box: Tuple[int, int, int, int] = None) -> bytes:
+    """
+    Returns png, cropped to box (left, top, right, bottom) in pixels if given, in image_format.
+    Needs Pillow unless png is written as is.
+    """
+    if image_format == "png" and box is None:
+        return png
+
+    from PIL import Image
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(png)) as image:
+        if box is not None:
+            image = image.crop(box)
+        if image_format == "webp":
+            image.save(out, format="WEBP", lossless=True)
+        else:
+            image.save(out, format="PNG", optimize=image_format == "optimized")
+    return out.getvalue()
+
+def temporary_fpath(fpath: str) -> str:
+    """
+    Temporary path next to fpath, unique to this thread.
+    Blobs are shared by worker processes and by machines on the same output folder, whose thread ids repeat.
+    """
+    return "{}.{}.{}.{}.tmp".format(fpath, socket.gethostname(), os.getpid(), threading.get_ident())
+
+def write_bytes(fpath: str, data: bytes, fsync: bool = False):
+    """Writes data to a temporary file, then renames it over fpath so readers never see a partial file."""
+    tmp_fpath = temporary_fpath(fpath)
+    try:
+        with open(tmp_fpath, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_fpath, fpath)
+    finally:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+
+def link_over(src: str, fpath: str):
+    """Hardlinks src at fpath, replacing what fpath was."""
+    tmp_fpath = temporary_fpath(fpath)
+    try:
+        os.link(src, tmp_fpath)
+        os.replace(tmp_fpath, fpath)
+    finally:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+
+class BlobStore:
+    """
+    Files named by the sha256 of their content, under <dir>/<first 2 hex digits>/.
+    Storing content already there writes nothing.
+    """
+    def __init__(self, store_dir: str):
+        self.dir = store_dir
+        # Hardlinks need a filesystem supporting them, copies are stored otherwise.
+        self.links = True
+
+    def fpath(self, digest: str, ext: str) -> str:
+        return os.path.join(self.dir, digest[:2], digest + ext)
+
+    def put(self, data: bytes, ext: str, fsync: bool = False) -> Tuple[str, bool]:
+        """Returns the path of data in the store, and whether it was new."""
+        blob = self.fpath(hashlib.sha256(data).hexdigest(), ext)
+        if os.path.exists(blob):
+            return blob, False
+
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        # Two writers storing the same content write the same file, either may win.
+        write_bytes(blob, data, fsync)
+        return blob, True
+
+    def place(self, blob: str, fpath: str, data: bytes, fsync: bool = False):
+        """Makes fpath have the content of blob, as a hardlink when possible."""
+        if self.links:
+            try:
+                link_over(blob, fpath)
+                return
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+                    logger.warning("Unable to hardlink screenshots, storing copies instead: {}".format(e))
+                    self.links = False
+                elif e.errno != errno.EMLINK:
+                    raise
+        write_bytes(fpath, data, fsync)
+
+class ScreenshotWriter:
+    """
+    Bounded queue of screenshots written by background threads, started on the first screenshot.
+    Once max_queued screenshots wait, capturing threads wait for room instead of growing memory.
+    Failed writes are logged and counted, they never fail the page which captured them.
+    """
+    def __init__(
+        self,
+        workers: int = DEF_WRITERS,
+        max_queued: int = DEF_MAX_QUEUED,
+        image_format: str = "png",
+        fsync: bool = False,
+        store_dir: str = None
+    ):
+        # Also notified whenever a pending screenshot is written.
+        self.lock = threading.Condition()
+        self.threads: List[threading.Thread] = []
+        self.configure(workers, max_queued, image_format, fsync, store_dir)
+
+    def configure(
+        self,
+        workers: int = DEF_WRITERS,
+        max_queued: int = DEF_MAX_QUEUED,
+        image_format: str = "png",
+        fsync: bool = False,
+        store_dir: str = None
+    ):
+        """
+        Sets how screenshots are written, through a BlobStore at store_dir if given.
+        Only call before the first screenshot or after shutdown().
+        """
+        assert image_format in FORMATS, "Unknown screenshot format: {}".format(image_format)
+        assert not self.threads, "Screenshot writers are already running."
+        if image_format != "png" and not pillow_available():
+            logger.warning("Pillow is not installed, writing screenshots as captured instead of {}.".format(image_format))
+            image_format = "png"
+
+        self.workers = max(workers, 1)
+        self.image_format = image_format
+        self.fsync = fsync
+        self.store = BlobStore(store_dir) if store_dir else None
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        # Absolute paths of the screenshots queued but not written yet.
+        self.pending: Set[str] = set()
+
+        self.written = 0
+        self.errors = 0
+        self.captured_bytes = 0
+        self.written_bytes = 0
+        # Screenshots whose content was already stored, and the bytes not written for them.
+        self.deduplicated = 0
+        self.saved_bytes = 0
+        # Screenshots cropped out of a capture of the viewport.
+        self.cropped = 0
+        self.write_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_depth = 0
+        self.failed: List[Tuple[str, str]] = []
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self.write_loop, name="tbw-screenshots-{}".format(i), daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, fpath: str, png: bytes, box: Tuple[int, int, int, int] = None) -> str:
+        """
+        Queues png, or the box of it, to be written at fpath in the configured format.
+        Returns the path it will have.
+        """
+        if not self.threads:
+            self.start()
+
+        fpath = screenshot_fpath(fpath, self.image_format)
+        with self.lock:
+            self.pending.add(os.path.abspath(fpath))
+            self.captured_bytes += len(png)
+
+        start = time.perf_counter()
+        self.queue.put((fpath, png, box))
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.wait_seconds += waited
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+        return fpath
+
+    def is_pending(self, fpath: str) -> bool:
+        """True if a screenshot is queued for fpath, or for its .webp counterpart."""
+        fpath = os.path.abspath(fpath)
+        with self.lock:
+            return fpath in self.pending or screenshot_fpath(fpath, "webp") in self.pending
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            fpath, png, box = item
+            try:
+                self.write(fpath, png, box)
+            except Exception as e:
+                logger.error("Unable to write screenshot {}: {}".format(fpath, e))
+                with self.lock:
+                    self.errors += 1
+                    self.failed.append((fpath, str(e)))
+            finally:
+                with self.lock:
+                    self.pending.discard(os.path.abspath(fpath))
+                    self.lock.notify_all()
+                self.queue.task_done()
+
+    def write(self, fpath: str, png: bytes, box: Tuple[int, int, int, int] = None):
+        start = time.perf_counter()
+        data = encode(png, self.image_format, box)
+        stored = True
+        if self.store is None:
+            write_bytes(fpath, data, self.fsync)
+        else:
+            blob, stored = self.store.put(data, os.path.splitext(fpath)[1], self.fsync)
+            self.store.place(blob, fpath, data, self.fsync)
+
+        with self.lock:
+            self.written += 1
+            if box is not None:
+                self.cropped += 1
+            if stored:
+                self.written_bytes += len(data)
+            else:
+                self.deduplicated += 1
+                self.saved_bytes += len(data)
+            self.write_seconds += time.perf_counter() - start
+
+    def wait_for(self, folder: str):
+        """Waits until no screenshot is pending under folder, while others may still be queued."""
+        prefix = os.path.join(os.path.abspath(folder), "")
+        with self.lock:
+            self.lock.wait_for(lambda: not any(p.startswith(prefix) for p in self.pending))
+
+    def flush(self):
+        """Waits for every queued screenshot to be written."""
+        self.queue.join()
+
+    def shutdown(self):
+        """Writes the queued screenshots and stops the writer threads."""
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self.lock:
+            return {
+                "written": self.written,
+                "errors": self.errors,
+                "queued": self.queue.qsize(),
+                "max_depth": self.max_depth,
+                "captured_bytes": self.captured_bytes,
+                "written_bytes": self.written_bytes,
+                "deduplicated": self.deduplicated,
+                "saved_bytes": self.saved_bytes,
+                "cropped": self.cropped,
+                "write_seconds": self.write_seconds,
+                "wait_seconds": self.wait_seconds,
+            }
+
+SCREENSHOTS = ScreenshotWriter()
+
+def save_screenshot(fpath: str, png: bytes, box: Tuple[int, int, int, int] = None) -> str:
+    """Queues png, or the box of it, to be written at fpath. Returns the path it will have."""
+    return SCREENSHOTS.submit(fpath, png, box)
+
+def log_screenshot_report():
+    stats = SCREENSHOTS.stats()
+    if not stats["written"] and not stats["errors"]:
+        return
+
+    rate = stats["written_bytes"] / stats["write_seconds"] if stats["write_seconds"] else 0.0
+    logger.info("Wrote {} screenshots, {:.1f}MB of {:.1f}MB captured, at {:.1f}MB/s per writer.".format(
+        stats["written"], stats["written_bytes"] / 1e6, stats["captured_bytes"] / 1e6, rate / 1e6))
+    logger.info("Screenshot queue peaked at {} waiting, pages waited {:.2f}s for room.".format(
+        stats["max_depth"], stats["wait_seconds"]))
+    if stats["cropped"]:
+        logger.info("{} screenshots were cropped out of viewport captures.".format(stats["cropped"]))
+    if SCREENSHOTS.store is not None:
+        logger.info("{} screenshots were already stored, saving {:.1f}MB.".format(stats["deduplicated"], stats["saved_bytes"] / 1e6))
+    if stats["errors"]:
+        logger.error("Failed to write {} screenshots, first: {}".format(stats["errors"], SCREENSHOTS.failed[0]))
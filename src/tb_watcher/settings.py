@@ -0,0 +1,54 @@
+"""
+Settings shared by every page of a crawl.
+By: ProgrammingIncluded
+"""
+from dataclasses import dataclass, field
+from typing import List
+
+@dataclass(init=True, repr=True)
+class CrawlSettings:
+    """
+    Tunables of a crawl.
+    Pages hand them down to the thread jobs they spawn.
+    """
+    # Empty tweet nodes that have been archived and scrolled past.
+    prune_dom: bool = False
+
+    # Page readiness, see readiness.wait_for_page_ready().
+    ready_timeout: float = 30.0
+    ready_quiet: float = 0.5
+    ready_jitter: float = 0.0
+
+    # Wait for new content after each scroll instead of a fixed time.
+    adaptive_scroll: bool = False
+
+    # Used to rebuild the scroll offset function where it cannot be passed, e.g. in worker processes.
+    scroll_algorithm: str = "window"
+    scroll_value: float = 5
+
+    # Only capture tweets missing from an existing archive, stopping after known_stop known tweets in a row.
+    incremental: bool = False
+    known_stop: int = 10
+
+    # How screenshots are written in the background, see screenshots.ScreenshotWriter.
+    screenshot_format: str = "png"
+    screenshot_writers: int = 2
+    screenshot_fsync: bool = False
+    # element captures each tweet, viewport crops the tweets on screen out of one capture.
+    capture_mode: str = "element"
+    # Folder of the blob store deduplicating screenshots, None to write each one.
+    screenshot_store: str = None
+
+    # Resources blocked in every browser, see resources.PRESETS.
+    resource_policy: str = "none"
+    blocked_urls: List[str] = field(default_factory=list)
+    # Count requests per page even when nothing is blocked.
+    resource_stats: bool = False
+    # Averages per page written by runs blocking nothing, to estimate what a policy saves.
+    resource_baseline: str = None
+
+    # Pack the folder of each profile into a tar once it is done, see pack.pack_folder().
+    pack: bool = False
+
+    # SQLite index every written tweets.json and metadata.json is added to, see index.init_index().
+    index_db: str = None
@@ -0,0 +1,261 @@
+"""
+Splits a follow list between several machines writing to the same snapshots folder.
+Profiles are partitioned by account id, lease files keep two nodes from crawling a profile at once
+and every node writes a report which are merged into one.
+
+By: ProgrammingIncluded
+"""
+# std
+import os
+import json
+import time
+import zlib
+import socket
+import threading
+
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Union
+from urllib.parse import parse_qs, urlparse
+
+# tb_watcher
+from tb_watcher.logger import logger
+from tb_watcher.storage import atomic_write_json
+
+LEASE_DIR = ".leases"
+REPORT_DIR = ".reports"
+MERGED_REPORT = "report.json"
+
+# Seconds a lease stays valid without being renewed.
+DEF_LEASE_TTL = 600.0
+
+@dataclass(init=True, repr=True)
+class Shard:
+    """The index-th of count parts of a follow list."""
+    index: int
+    count: int
+
+    def __str__(self):
+        return "{}/{}".format(self.index, self.count)
+
+def parse_shard(value: str) -> Shard:
+    """Parses i/N, with 0 <= i < N. Raises ValueError otherwise, so argparse can report it."""
+    index, _, count = value.partition("/")
+    shard = Shard(int(index), int(count))
+    if not 0 <= shard.index < shard.count:
+        raise ValueError("Shard must be i/N with 0 <= i < N, got: {}".format(value))
+    return shard
+
+def in_shard(account_id: str, shard: Union[Shard, None]) -> bool:
+    """Deterministic on every machine, unlike hash() which is salted per process."""
+    if shard is None:
+        return True
+    return zlib.crc32(str(account_id).encode("utf-8")) % shard.count == shard.index
+
+def pid_alive(pid: int) -> bool:
+    # Signals would terminate the process on Windows, leases expire there instead.
+    if os.name == "nt":
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Alive, owned by someone else.
+        return True
+    return True
+
+def owner_dead(owner: str) -> bool:
+    """True if owner, as host:pid, is a process of this host which is gone."""
+    host, _, pid = owner.rpartition(":")
+    return host == socket.gethostname() and pid.isdigit() and not pid_alive(int(pid))
+
+def profile_key(url: str) -> str:
+    """Identifies a profile before it is loaded, by the user_id of export links or the handle otherwise."""
+    parsed = urlparse(url)
+    user_ids = parse_qs(parsed.query).get("user_id")
+    if user_ids:
+        return user_ids[0]
+    return parsed.path.strip("/").replace("/", "_").lower() or "root"
+
+class LeaseManager:
+    """
+    Lease files of the profiles this process crawls, under <root>/.leases.
+    A lease is created exclusively and renewed by touching it. One left by a crashed node
+    expires after ttl seconds, or right away if that node was this host, and is taken over.
+    It is renamed away first so only one node wins.
+    """
+    def __init__(self, root_dir: str, ttl: float = DEF_LEASE_TTL):
+        self.dir = os.path.join(root_dir, LEASE_DIR)
+        self.ttl = ttl
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.held: Dict[str, str] = {}
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_loop, name="tbw-lease-heartbeat", daemon=True)
+        self.heartbeat.start()
+
+        self.contended = 0
+        self.taken_over = 0
+
+    def fpath(self, key: str) -> str:
+        return os.path.join(self.dir, "{}.lease".format(key))
+
+    def acquire(self, key: str) -> bool:
+        """Returns True if this process now holds the lease of key."""
+        fpath = self.fpath(key)
+        for _ in range(2):
+            try:
+                fd = os.open(fpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.take_over_expired(fpath):
+                    with self.lock:
+                        self.contended += 1
+                    return False
+                continue
+
+            with os.fdopen(fd, "w") as f:
+                f.write(self.owner)
+            with self.lock:
+                self.held[key] = fpath
+            return True
+        return False
+
+    def expired(self, fpath: str) -> bool:
+        if time.time() - os.path.getmtime(fpath) >= self.ttl:
+            return True
+        with open(fpath, encoding="utf-8") as f:
+            return owner_dead(f.read().strip())
+
+    def take_over_expired(self, fpath: str) -> bool:
+        """Removes the lease at fpath if it expired. Of several nodes doing so, only one succeeds."""
+        expired_fpath = "{}.expired-{}".format(fpath, self.owner.replace(":", "-"))
+        try:
+            if not self.expired(fpath):
+                return False
+            os.replace(fpath, expired_fpath)
+        except FileNotFoundError:
+            # Released or taken over by someone else meanwhile, try again.
+            return True
+
+        # Another node may have taken over first, the lease moved away would then be its new one.
+        if not self.expired(expired_fpath):
+            try:
+                os.link(expired_fpath, fpath)
+            except FileExistsError:
+                pass
+            os.remove(expired_fpath)
+            return False
+
+        os.remove(expired_fpath)
+        logger.info("Took over expired lease: {}".format(fpath))
+        with self.lock:
+            self.taken_over += 1
+        return True
+
+    def release(self, key: str):
+        with self.lock:
+            fpath = self.held.pop(key, None)
+        if fpath is not None:
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                logger.warning("Lease was already gone: {}".format(fpath))
+
+    def renew_loop(self):
+        while not self.stopped.wait(self.ttl / 3):
+            with self.lock:
+                fpaths = list(self.held.values())
+            for fpath in fpaths:
+                try:
+                    os.utime(fpath)
+                except OSError as e:
+                    logger.warning("Unable to renew lease {}: {}".format(fpath, e))
+
+    def shutdown(self):
+        """Stops renewing and releases every lease still held."""
+        self.stopped.set()
+        with self.lock:
+            keys = list(self.held.keys())
+        for key in keys:
+            self.release(key)
+
+LEASES: Union[LeaseManager, None] = None
+
+def init_leases(root_dir: str, ttl: float = DEF_LEASE_TTL) -> LeaseManager:
+    global LEASES
+    LEASES = LeaseManager(root_dir, ttl)
+    return LEASES
+
+def acquire_profile(url: str) -> bool:
+    """Returns True if the profile may be crawled, always when leases are not used."""
+    if LEASES is None:
+        return True
+
+    if LEASES.acquire(profile_key(url)):
+        return True
+    logger.info("Profile is being crawled by another node, skipping: {}".format(url))
+    return False
+
+def release_profile(url: str):
+    if LEASES is not None:
+        LEASES.release(profile_key(url))
+
+def shard_name(shard: Union[Shard, None]) -> str:
+    if shard is None:
+        return "{}-{}".format(socket.gethostname(), os.getpid())
+    return "shard-{}-of-{}".format(shard.index, shard.count)
+
+def write_shard_report(root_dir: str, shard: Union[Shard, None], profiles: List[dict]) -> str:
+    """Writes the report of this node under <root>/.reports. Returns its path."""
+    report_dir = os.path.join(root_dir, REPORT_DIR)
+    os.makedirs(report_dir, exist_ok=True)
+    fpath = os.path.join(report_dir, "{}.json".format(shard_name(shard)))
+    atomic_write_json(fpath, {
+        "shard": str(shard) if shard is not None else None,
+        "host": socket.gethostname(),
+        "finished_at": time.time(),
+        "profiles": profiles,
+    })
+    return fpath
+
+def merge_reports(root_dir: str) -> Tuple[str, dict]:
+    """
+    Merges the report of every node into <root>/report.json.
+    A profile reported by several nodes keeps its latest successful outcome.
+    Returns its path and content.
+    """
+    report_dir = os.path.join(root_dir, REPORT_DIR)
+    reports = []
+    for fname in sorted(os.listdir(report_dir)) if os.path.isdir(report_dir) else []:
+        if not fname.endswith(".json"):
+            continue
+        with open(os.path.join(report_dir, fname), encoding="utf-8") as f:
+            reports.append(json.load(f))
+
+    # Archived beats skipped, e.g. by another node holding its lease, which beats failed.
+    def _rank(p: dict) -> int:
+        if p["error"] is not None:
+            return 0
+        return 1 if p["skipped"] else 2
+
+    profiles = {}
+    for report in sorted(reports, key=lambda r: r["finished_at"]):
+        for p in report["profiles"]:
+            previous = profiles.get(p["url"])
+            if previous is None or _rank(p) >= _rank(previous):
+                profiles[p["url"]] = dict(p, shard=report["shard"], host=report["host"])
+
+    merged = {
+        "shards": sorted(set(r["shard"] or r["host"] for r in reports)),
+        "profiles": len(profiles),
+        "tweets": sum(p["tweets"] for p in profiles.values()),
+        "failed": sum(p["error"] is not None for p in profiles.values()),
+        "skipped": sum(bool(p["skipped"]) for p in profiles.values()),
+        "results": sorted(profiles.values(), key=lambda p: p["url"]),
+    }
+    fpath = os.path.join(root_dir, MERGED_REPORT)
+    atomic_write_json(fpath, merged)
+    return fpath, merged
@@ -0,0 +1,148 @@
+"""
+Writes archive files so a crash or kill never leaves them half written.
+Tweets are streamed to tweets.jsonl as they are captured, tweets.json is compacted from it and the stream removed.
+
+By: ProgrammingIncluded
+"""
+# std
+import os
+import json
+import threading
+
+from dataclasses import asdict
+from typing import Callable, List, Set, Union
+
+# tb_watcher
+from tb_watcher.logger import logger
+
+TWEETS_JSONL = "tweets.jsonl"
+TWEETS_JSON = "tweets.json"
+
+# Streamed tweets between two fsyncs of the stream.
+DEF_CHECKPOINT = 20
+
+# Called with the path of every file written by atomic_write_json(), e.g. to index it.
+WRITE_LISTENERS: List[Callable[[str], None]] = []
+
+def add_write_listener(listener: Callable[[str], None]):
+    WRITE_LISTENERS.append(listener)
+
+def atomic_write_json(fpath: str, data: Union[dict, list]):
+    """Writes data to a temporary file, then renames it over fpath so readers never see a partial file."""
+    tmp_fpath = "{}.{}.{}.tmp".format(fpath, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_fpath, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fpath, fpath)
+    finally:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+
+    for listener in WRITE_LISTENERS:
+        try:
+            listener(fpath)
+        except Exception as e:
+            # The file is written, failing to process it further should not fail the crawl.
+            logger.warning("Unable to process written file {}: {}".format(fpath, e))
+
+class TweetStream:
+    """
+    Append-only JSON lines of the tweets of a page, one line flushed per tweet.
+    A tweet updated after it was written, e.g. marked as a boost, is appended again and the last line wins.
+    Lines are fsynced every checkpoint tweets and on close.
+    """
+    def __init__(self, root_dir: str, checkpoint: int = DEF_CHECKPOINT):
+        self.fpath = os.path.join(root_dir, TWEETS_JSONL)
+        self.checkpoint = checkpoint
+        self.file = None
+        # Where the lines of this stream start, earlier ones are from previous runs.
+        self.start = os.path.getsize(self.fpath) if os.path.exists(self.fpath) else 0
+        self.written: Set[str] = set()
+        self.unsynced = 0
+
+    def write(self, tweet):
+        """Appends a Tweet."""
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.fpath), exist_ok=True)
+            self.file = open(self.fpath, "a", encoding="utf-8")
+
+        self.file.write(json.dumps(asdict(tweet), ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.written.add(tweet.id)
+
+        self.unsynced += 1
+        if self.checkpoint and self.unsynced >= self.checkpoint:
+            self.sync()
+
+    def update(self, tweet):
+        """Appends tweet again if it was written before."""
+        if tweet.id in self.written:
+            self.write(tweet)
+
+    def sync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+def read_tweet_stream(fpath: str, since: int = 0) -> List[dict]:
+    """
+    Returns the tweets of a stream in the order they were first written, using the last line of each.
+    Only lines from byte offset since are read. A line cut short by a crash is ignored.
+    """
+    tweets = {}
+    with open(fpath, "rb") as f:
+        f.seek(since)
+        for i, line in enumerate(f):
+            try:
+                tweet = json.loads(line.decode("utf-8"))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                logger.warning("Ignoring unreadable line {} of {}.".format(i + 1, fpath))
+                continue
+
+            # Tweets without an id can not be told apart, keep each of them.
+            key = tweet.get("id")
+            if key in (None, "null", "NULL"):
+                key = "line-{}".format(i)
+            tweets[key] = tweet
+    return list(tweets.values())
+
+def load_known_tweets(root_dir: str) -> List[dict]:
+    """
+    Returns the tweets archived in root_dir by previous runs.
+    These are the ones of tweets.json, then those only tweets.jsonl holds if a run was interrupted.
+    """
+    tweets = {}
+    json_fpath = os.path.join(root_dir, TWEETS_JSON)
+    if os.path.exists(json_fpath):
+        with open(json_fpath, encoding="utf-8") as f:
+            tweets = {t["id"]: t for t in json.load(f)}
+
+    jsonl_fpath = os.path.join(root_dir, TWEETS_JSONL)
+    if os.path.exists(jsonl_fpath):
+        for t in read_tweet_stream(jsonl_fpath):
+            tweets.setdefault(t.get("id"), t)
+    return list(tweets.values())
+
+def compact_tweet_stream(root_dir: str, since: int = 0, previous: List[dict] = None) -> int:
+    """
+    Writes tweets.json from the lines of tweets.jsonl of root_dir from byte offset since,
+    followed by the previous tweets not among them, then removes tweets.jsonl. Returns the number of tweets.
+    """
+    fpath = os.path.join(root_dir, TWEETS_JSONL)
+    tweets = read_tweet_stream(fpath, since) if os.path.exists(fpath) else []
+
+    seen = set(t.get("id") for t in tweets)
+    tweets.extend(t for t in previous or [] if t.get("id") not in seen)
+    atomic_write_json(os.path.join(root_dir, TWEETS_JSON), tweets)
+    # Everything it held is in tweets.json now.
+    if os.path.exists(fpath):
+        os.remove(fpath)
+    return len(tweets)
@@ -1,65 +1,268 @@
 """
-Multithreading globa queue logic.
+Multithreading global executor logic.
+Jobs are callables taking is_new_thread, which is False when run on the caller's thread.
+Queued jobs run lowest priority first, e.g. (depth, profile index), then in submission order.
 
 By: ProgrammingingIncluded
 """
+import math
 import time
+import itertools
 import threading
 
-from queue import Queue
+from contextlib import contextmanager
+from queue import PriorityQueue
+from concurrent.futures import Future
+from typing import Callable, List
 
-# includes main thread
-THREADS = []
-T_QUEUE = Queue()
+from tb_watcher.logger import logger
 
-BUSY_LOCK = threading.Lock()
-BUSY_THREADS = 0
-NUM_THREADS = 0
+# Default number of jobs waiting for a worker before the main thread waits to submit more.
+DEF_MAX_QUEUED = 64
 
-def get_job():
-    global BUSY_LOCK
-    global BUSY_THREADS
+# Priority of jobs submitted outside of any job.
+DEF_PRIORITY = (0,)
 
-    task = None
-    with BUSY_LOCK:
+# Sorts after every job, so workers stop once the jobs queued before are done.
+STOP_PRIORITY = (math.inf,)
+
+class JobGroup:
+    """
+    Tracks the jobs submitted while the group is active, including the jobs those submit themselves.
+    Used to account thread jobs to the profile which spawned them.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.futures: List[Future] = []
+        self.failures = 0
+        self.finished_at = None
+        self.callbacks: List[Callable[[], None]] = []
+
+    def when_done(self, callback: Callable[[], None]):
+        """Calls callback once every job of the group is done, right away if they are."""
+        with self.cond:
+            if not all(f.done() for f in self.futures):
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def add(self, future: Future):
+        with self.cond:
+            self.futures.append(future)
+        future.add_done_callback(self.job_done)
+
+    def job_done(self, future: Future):
+        with self.cond:
+            if not future.cancelled() and future.exception() is not None:
+                self.failures += 1
+            self.finished_at = time.perf_counter()
+            self.cond.notify_all()
+
+            callbacks = []
+            if all(f.done() for f in self.futures):
+                callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            callback()
+
+    def done(self) -> bool:
+        with self.cond:
+            return all(f.done() for f in self.futures)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Blocks until every job of the group is done. Returns False on timeout."""
+        with self.cond:
+            return self.cond.wait_for(lambda: all(f.done() for f in self.futures), timeout=timeout)
+
+    def num_jobs(self) -> int:
+        with self.cond:
+            return len(self.futures)
+
+class CrawlExecutor:
+    """
+    Runs jobs on worker threads and hands back futures with their results or exceptions.
+    Workers are only started once, so the executor can be reused across profiles.
+
+    The main thread waits for room once max_queued of its jobs are queued, for backpressure.
+    Jobs submitted by workers are always queued and do not count toward it, so workers
+    never wait on each other and their jobs still run in priority order.
+
+    Jobs are queued by priority, jobs submitted by a job inherit its priority unless given one.
+    """
+    def __init__(self, max_queued: int = DEF_MAX_QUEUED):
+        self.max_queued = max_queued
+        self.queue = None
+        self.workers: List[threading.Thread] = []
+        self.local = threading.local()
+        # Breaks ties between equal priorities in submission order.
+        self.seq = itertools.count()
+
+        # Jobs queued or running, and jobs of the main thread only queued.
+        self.pending = 0
+        self.queued = 0
+        self.cond = threading.Condition()
+
+    def start(self, num_workers: int, max_queued: int = None):
+        """Starts workers until there are num_workers of them."""
+        with self.cond:
+            if self.queue is None:
+                if max_queued is not None:
+                    self.max_queued = max_queued
+                self.queue = PriorityQueue()
+
+            while len(self.workers) < num_workers:
+                t = threading.Thread(target=self.worker_thread, args=(self.queue,), name="tbw-worker-{}".format(len(self.workers)))
+                t.daemon = True
+                self.workers.append(t)
+                t.start()
+
+    def num_workers(self) -> int:
+        with self.cond:
+            return len(self.workers)
+
+    def is_worker(self) -> bool:
+        return getattr(self.local, "is_worker", False)
+
+    def current_group(self) -> JobGroup:
+        return getattr(self.local, "group", None)
+
+    def current_priority(self) -> tuple:
+        return getattr(self.local, "priority", DEF_PRIORITY)
+
+    @contextmanager
+    def priority(self, priority: tuple):
+        """Jobs submitted by this thread inherit priority while active."""
+        previous = self.current_priority()
+        self.local.priority = priority
+        try:
+            yield priority
+        finally:
+            self.local.priority = previous
+
+    @contextmanager
+    def group(self, group: JobGroup):
+        """Adds every job submitted by this thread to group while active."""
+        previous = self.current_group()
+        self.local.group = group
         try:
-            task = T_QUEUE.get(block=False)
-            BUSY_THREADS += 1
-        except:
-            pass
-    return task
-
-def worker_thread():
-    global BUSY_LOCK
-    global BUSY_THREADS
-
-    while True:
-        task = get_job()
-        if task is None:
-            time.sleep(0.2)
-        else:
-            task(True)
-            with BUSY_LOCK:
-                BUSY_THREADS -= 1
-
-def spawn_threads(num_threads: int = 4):
-    global NUM_THREADS
-    NUM_THREADS = num_threads - 1
+            yield group
+        finally:
+            self.local.group = previous
+
+    def worker_thread(self, queue: PriorityQueue):
+        # Shutting down clears self.queue before the workers take their stop job.
+        self.local.is_worker = True
+        while True:
+            priority, _, job, future, group, bounded = queue.get()
+            if job is None:
+                queue.task_done()
+                return
+
+            if bounded:
+                with self.cond:
+                    self.queued -= 1
+                    self.cond.notify_all()
+
+            try:
+                self.run(job, future, group, priority, True)
+            finally:
+                queue.task_done()
+
+    def run(self, job: Callable, future: Future, group: JobGroup, priority: tuple, is_new_thread: bool):
+        try:
+            if future.set_running_or_notify_cancel():
+                # Jobs submitted by this job belong to the same group and inherit its priority.
+                with self.group(group), self.priority(priority):
+                    try:
+                        future.set_result(job(is_new_thread))
+                    except Exception as e:
+                        logger.exception("Job failed: {}".format(e))
+                        future.set_exception(e)
+                    except BaseException as e:
+                        future.set_exception(e)
+                        # Ctrl-C or exit during an inline job stops its caller too, workers keep going.
+                        if not is_new_thread:
+                            raise
+        finally:
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify_all()
+
+    def submit(self, job: Callable, inline: bool = False, priority: tuple = None) -> Future:
+        """
+        Queues a job, or runs it right away on this thread if inline or there are no workers.
+        Outside of workers, waits while max_queued of its jobs are queued.
+        Without priority, the job inherits the priority of the job submitting it.
+        """
+        future = Future()
+        if priority is None:
+            priority = self.current_priority()
+        group = self.current_group()
+        if group is not None:
+            group.add(future)
+
+        with self.cond:
+            inline = inline or len(self.workers) == 0
+            # Only the main thread may wait for room in the queue.
+            bounded = not inline and not self.is_worker()
+            if bounded:
+                self.cond.wait_for(lambda: self.queued < self.max_queued)
+                self.queued += 1
+            self.pending += 1
+            if not inline:
+                self.queue.put((priority, next(self.seq), job, future, group, bounded))
+
+        if inline:
+            self.run(job, future, group, priority, False)
+        return future
+
+    def join(self, timeout: float = None) -> bool:
+        """Blocks until every job has finished. Returns False on timeout."""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+    def done(self) -> bool:
+        with self.cond:
+            return self.pending == 0
+
+    def shutdown(self, wait: bool = True):
+        """Stops workers once the jobs queued so far are done."""
+        with self.cond:
+            workers, self.workers = self.workers, []
+            queue = self.queue
+            self.queue = None
+
+        for _ in workers:
+            queue.put((STOP_PRIORITY, next(self.seq), None, None, None, False))
+
+        if wait:
+            for t in workers:
+                t.join()
+
+EXECUTOR = CrawlExecutor()
+
+def spawn_threads(num_threads: int = 4, max_queued: int = None):
+    """Makes sure num_threads - 1 workers are running, the main thread counts as one."""
     assert num_threads >= 1, "There should be atleast a main thread."
-    for _ in range(num_threads - 1):
-        t = threading.Thread(target=worker_thread, args=())
-        t.daemon = True
-        t.start()
-
-def threads_done():
-    if NUM_THREADS == 0:
-        return True
-
-    with BUSY_LOCK:
-        return T_QUEUE.qsize() == 0 and BUSY_THREADS == 0
-
-def add_job(job):
-    if NUM_THREADS == 0:
-        job(False)
-    else:
-        T_QUEUE.put(job)
+    EXECUTOR.start(num_threads - 1, max_queued=max_queued)
+
+def threads_done() -> bool:
+    return EXECUTOR.done()
+
+def wait_for_jobs(timeout: float = None) -> bool:
+    """Blocks until all jobs are done. Returns False on timeout."""
+    return EXECUTOR.join(timeout)
+
+def shutdown_threads(wait: bool = True):
+    EXECUTOR.shutdown(wait)
+
+def add_job(job: Callable, inline: bool = False, priority: tuple = None) -> Future:
+    return EXECUTOR.submit(job, inline=inline, priority=priority)
+
+def current_priority() -> tuple:
+    """Priority of the job running on this thread."""
+    return EXECUTOR.current_priority()
+
+def job_group(group: JobGroup):
+    """Context manager adding every job submitted by this thread to group."""
+    return EXECUTOR.group(group)